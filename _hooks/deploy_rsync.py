@@ -19,15 +19,87 @@
 
 import subprocess
 
-REMOTE_PATH = 'user@host:/path/'
+
+class Transport(object):
+    """ base class for deploy targets. `target` identifies the
+        destination, the manifest of the last deploy is stored per target.
+    """
+
+    def __init__(self, target):
+        self.target = target
+
+    def transfer(self, root, upload, remove):
+        """ upload the given paths (relative to root) and remove the
+            paths, which no longer exist. return true on success.
+        """
+        raise NotImplementedError()
+
+
+class RsyncTransport(Transport):
+    """ transfer only the listed files with rsync. removed files are
+        deleted on the remote side using --delete-missing-args (needs
+        rsync >= 3.1).
+    """
+
+    CMD = ['rsync', '-ahz', '--from0', '--files-from=-',
+           '--delete-missing-args']
+
+    def transfer(self, root, upload, remove):
+        p = subprocess.Popen(self.CMD + [root.rstrip('/') + '/', self.target],
+                             stdin = subprocess.PIPE)
+        p.communicate('\0'.join(upload + remove))
+        if p.returncode != 0:
+            sys.stderr.write('rsync failed! (return code: %d)\n' %
+                             p.returncode)
+        return p.returncode == 0
+
+
+class LocalTransport(Transport):
+    """ copy to a directory on the local machine.
+    """
+
+    def transfer(self, root, upload, remove):
+        for path in upload:
+            syncFile(os.path.join(root, path),
+                     os.path.join(self.target, path))
+        for path in remove:
+            fname = os.path.join(self.target, path)
+            if os.path.exists(fname):
+                os.unlink(fname)
+            try:
+                os.removedirs(os.path.dirname(fname))
+            except OSError:
+                pass
+        return True
+
+
+TRANSPORT = RsyncTransport('user@host:/path/')
+
+
+def deployPlan(current, deployed):
+    """ compare two manifests and return the sorted lists of files to
+        upload and to remove.
+    """
+    upload = sorted(path for path, entry in current.iteritems()
+                        if deployed.get(path, [None] * 3)[2] != entry[2])
+    remove = sorted(set(deployed) - set(current))
+    return upload, remove
+
 
 @wrap(Site.setupOptions)
 def setupOptions(forig, self, parser):
     forig(self, parser)
-    parser.set_defaults(deploy = False)
+    parser.set_defaults(deploy = False, deploy_dry_run = False,
+                        deploy_full = False)
     parser.add_option('--deploy',
                       action = 'store_true', dest = 'deploy',
                       help = 'deploy site')
+    parser.add_option('--deploy-dry-run',
+                      action = 'store_true', dest = 'deploy_dry_run',
+                      help = 'only print the files a deploy would transfer')
+    parser.add_option('--deploy-full',
+                      action = 'store_true', dest = 'deploy_full',
+                      help = 'ignore the manifest of the last deploy')
 
 
 @wrap(Site.run)
@@ -35,12 +107,33 @@ def run_rsync(forig, self):
     # first run 'default' actions and maybe other run hooks
     forig(self)
 
-    if self.options.deploy:
+    if (self.options.deploy or self.options.deploy_dry_run) and \
+            not self.live:
+
+        fname = os.path.join(self.CACHE_DIR, 'deployed-%s.json' %
+                             hashlib.sha1(TRANSPORT.target).hexdigest()[:8])
+        current = self.deploy_manifest.refresh()
+        self.deploy_manifest.save()
+        deployed = {}
+        if not self.options.deploy_full:
+            deployed = DeployManifest.load(fname)
+        upload, remove = deployPlan(current, deployed)
+
+        if self.options.deploy_dry_run:
+            for path in upload:
+                print '%s %s' % ('~' if path in deployed else '+', path)
+            for path in remove:
+                print '- %s' % path
+            sys.stderr.write('deploy to %s: %d to upload, %d to remove\n' %
+                             (TRANSPORT.target, len(upload), len(remove)))
+            return
 
-        cmd = 'rsync -ahz --delete %s/* %s\n' % (self.DEPLOY_DIR, REMOTE_PATH)
-        sys.stderr.write('deploy to >>> %s\n' % REMOTE_PATH)
-        ret = subprocess.call(cmd, shell=True)
-        if ret == 0:
+        sys.stderr.write('deploy to >>> %s (%d to upload, %d to remove)\n' %
+                         (TRANSPORT.target, len(upload), len(remove)))
+        if not upload and not remove:
+            sys.stderr.write('<<< up to date\n')
+        elif TRANSPORT.transfer(self.DEPLOY_DIR, upload, remove):
+            DeployManifest.dump(fname, current)
             sys.stderr.write('<<< finished\n')
         else:
-            sys.stderr.write('<<< failed! (return code: %d)\n' % ret)
+            sys.stderr.write('<<< failed!\n')
@@ -22,11 +22,9 @@ copy 'markdown2.py' from http://code.google.com/p/python-markdown2/
 to _libs directory.
 """
 
-import markdown2
-import functools
-
-Config.transformers['markdown2'] = functools.partial(
-            markdown2.markdown,
+# markdown2 is imported, when the first file is transformed
+Config.transformers['markdown2'] = LazyTransformer(
+            'markdown2', 'markdown',
             extras={'code-color': {"classes": True}})
 
 Config.transformers['md2'] = Config.transformers['markdown2']
@@ -0,0 +1,132 @@
+# vim:syntax=python:sw=4:ts=4:expandtab
+#
+# Copyright (C) 2012 Rico Schiekel (fire at downgra dot de)
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License version 2
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+#
+
+#
+# split listing pages into several pages. a page with the yaml header
+#
+#   paginate: 10
+#   paginate_collection: categories.python    # default: posts
+#   paginate_reverse: false                   # default: true (newest first)
+#
+# is written once per 10 posts of the collection, the first page to the
+# path of the page itself, the following to page/N/ below its directory
+# (e.g. page/2/index.html). each page gets a `paginator` with only its
+# slice of posts:
+#
+#   paginator.posts, paginator.page, paginator.per_page,
+#   paginator.total_pages, paginator.total_posts,
+#   paginator.previous_page, paginator.previous_page_path,
+#   paginator.next_page, paginator.next_page_path
+#
+# a page only depends on its own slice (and the previous and next page),
+# so only pages whose slice changed are generated again. pages showing
+# total_pages or total_posts depend on the whole collection.
+#
+
+import os
+
+
+class Paginator(AttrDict):
+    """ the paginator of a single page. looking up the totals is
+        recorded as lookup of the paginated site collection.
+    """
+
+    TOTALS = ('total_pages', 'total_posts')
+
+    def __init__(self, collection, **kwargs):
+        super(Paginator, self).__init__(**kwargs)
+        object.__setattr__(self, 'collection', collection)
+
+    def __getitem__(self, name):
+        if name in self.TOTALS and SiteDict.accessed is not None:
+            SiteDict.accessed.add(self.collection)
+        return super(Paginator, self).__getitem__(name)
+
+
+class Pager(Page):
+    """ a single page of a paginated page.
+    """
+
+    def __init__(self, filename, layout, context, paginator):
+        super(Pager, self).__init__(filename, layout, context)
+
+        self.paginator = paginator
+        self.context.paginator = paginator
+
+    @staticmethod
+    def pagePath(path, number):
+        """ the output path of page number of path.
+        """
+        if number == 1:
+            return path
+        dirname, basename = os.path.split(path)
+        return os.path.join(dirname, 'page', str(number), basename)
+
+    @property
+    def path(self):
+        return self.pagePath(super(Pager, self).path, self.paginator.page)
+
+    def inputs(self):
+        return dict((name, value)
+                    for name, value in dict.iteritems(self.paginator)
+                    if name not in Paginator.TOTALS)
+
+
+def paginate(site, tmpl):
+    """ yield a Pager for every page of tmpl.
+    """
+    per_page = max(1, int(tmpl.context.get('paginate')))
+    posts = site.context.site
+    keys = tmpl.context.get('paginate_collection', 'posts').split('.')
+    for key in keys:
+        # dict.get doesn't record the lookup (see SiteDict), the pages
+        # should only depend on their slice.
+        posts = dict.get(posts, key) or {}
+    posts = list(posts)
+    if tmpl.context.get('paginate_reverse', True):
+        posts.reverse()
+
+    total = max(1, (len(posts) + per_page - 1) / per_page)
+    path = tmpl.path
+    url = lambda n: n and Pager.pagePath(path, n).replace(os.path.sep, '/')
+    for n in range(1, total + 1):
+        prev = n > 1 and n - 1 or None
+        next = n < total and n + 1 or None
+        paginator = Paginator(keys[0],
+                              posts = posts[(n - 1) * per_page:n * per_page],
+                              page = n,
+                              per_page = per_page,
+                              total_pages = total,
+                              total_posts = len(posts),
+                              previous_page = prev,
+                              previous_page_path = url(prev),
+                              next_page = next,
+                              next_page_path = url(next))
+        yield Pager(tmpl.filename, tmpl.layouts, site.context, paginator)
+
+
+@wrap(Site.write_template)
+def write_paginated(forig, self, tmpl):
+    if isinstance(tmpl, Pager) or not isinstance(tmpl, Page) or \
+            not tmpl.context.get('paginate'):
+        return forig(self, tmpl)
+    written = False
+    for pager in paginate(self, tmpl):
+        written = forig(self, pager) or written
+    return written
@@ -19,6 +19,7 @@
 
 import os
 import datetime
+import collections
 
 
 class Post(Page):
@@ -33,6 +34,11 @@ class Post(Page):
         ext = os.path.splitext(base)
 
         self.year, self.month, self.day, self.slug = ext[0].split('-', 3)
+        self.date = datetime.datetime(int(self.year),
+                                      int(self.month),
+                                      int(self.day))
+        # posts of the same day are ordered by filename
+        self.sortkey = (self.date, base)
 
         self.context.post = self
 
@@ -44,12 +50,6 @@ class Post(Page):
             del self.context['categories']
         self.categories = [c.strip() for c in cats.split(',') if c]
 
-    @property
-    def date(self):
-        return datetime.datetime(int(self.year),
-                                 int(self.month),
-                                 int(self.day))
-
     @property
     def url(self):
         return os.path.join(self.year, self.month, self.day, self.slug)
@@ -67,53 +67,87 @@ class Post(Page):
         return self.context.get('publish', True)
 
     def __cmp__(self, other):
-        return cmp(self.date, other.date)
+        return cmp(self.sortkey, other.sortkey)
 
     @staticmethod
     def setup(clazz):
         clazz.POST_DIR = os.path.join(clazz.BASE_DIR, '_posts')
+        clazz.post_cache = {}
+
+        def read_post(self, fname):
+            """ return the post of fname. if the changed paths are known,
+                the post of the last build is reused for unchanged files.
+            """
+            post = self.post_cache.get(fname)
+            if post is None or self.changed is None or \
+                    fname in self.changed:
+                return Post(fname, self.layouts, self.context)
+            post.layouts = self.layouts
+            post.release()
+            return post
 
         def read_posts(self):
             self.posts = []
             if os.path.isdir(self.POST_DIR):
-                self.posts = [Post(os.path.join(self.POST_DIR, f),
-                                   self.layouts,
-                                   self.context)
+                self.posts = [read_post(self, os.path.join(self.POST_DIR, f))
                               for f in self.ignoreFilter(os.listdir(
                                                          self.POST_DIR))]
-                self.context.site.posts = sorted(p for p in self.posts
-                                                    if p.publish)
-                self.context.site.unpublished_posts = sorted(p for
-                                                             p in self.posts
-                                                             if not p.publish)
+                posts = sorted(self.posts, key = lambda p: p.sortkey)
+                self.context.site.posts = [p for p in posts if p.publish]
+                self.context.site.unpublished_posts = [p for p in posts
+                                                       if not p.publish]
+            self.post_cache = dict((p.filename, p) for p in self.posts)
 
         def calc_categories(self):
+            # use the sorted posts, so the categories are sorted, too
             self.categories = AttrDict()
-            for post in self.posts:
-                if post.publish:
-                    for cat in post.categories:
-                        self.categories.setdefault(cat, []).append(post)
-                    if not post.categories:
-                        self.categories.setdefault(None, []).append(post)
+            for post in self.context.site.get('posts', []):
+                for cat in post.categories:
+                    self.categories.setdefault(cat, []).append(post)
+                if not post.categories:
+                    self.categories.setdefault(None, []).append(post)
             self.context.site.categories = self.categories
 
+        def calc_indexes(self):
+            """ index the sorted posts by date ('yyyy', 'yyyy/mm' and
+                'yyyy/mm/dd'), by url and by slug.
+            """
+            archive = collections.OrderedDict()
+            by_url = {}
+            by_slug = {}
+            for post in self.context.site.get('posts', []):
+                for key in (post.year,
+                            '/'.join((post.year, post.month)),
+                            '/'.join((post.year, post.month, post.day))):
+                    archive.setdefault(key, []).append(post)
+                by_url[post.url.replace(os.path.sep, '/')] = post
+                by_slug[post.slug] = post
+            self.context.site.archive = archive
+            self.context.site.posts_by_url = by_url
+            self.context.site.posts_by_slug = by_slug
+
         def write_posts(self):
             for p in self.posts:
-                p.write()
+                self.write_template(p)
 
         @wrap(clazz.prepare)
         def site_prepare(forig, self):
-            """ read all posts and calculate the categories.
+            """ read all posts and calculate the categories and indexes.
             """
             forig(self)
-            read_posts(self)
-            calc_categories(self)
+            with profiler.span('read_posts'):
+                read_posts(self)
+            with profiler.span('calc_categories'):
+                calc_categories(self)
+            with profiler.span('calc_indexes'):
+                calc_indexes(self)
 
         @wrap(clazz.run)
         def site_run(forig, self):
             """ write all posts to the deploy directory.
             """
-            write_posts(self)
+            with profiler.span('write_posts'):
+                write_posts(self)
             forig(self)
 
 Post.setup(Site) # whooha!
@@ -100,7 +100,8 @@ def setup_posts_ui():
                 # load yaml header
                 mo = Template.RE_YAML.match(content)
                 if mo and mo.groupdict().get('yaml'):
-                    meta = yaml.load(mo.groupdict().get('yaml'))
+                    meta = yaml.load(mo.groupdict().get('yaml'),
+                                     Loader = YAML_LOADER)
                     title = meta.get('title')
 
                 if title:
@@ -35,13 +35,185 @@ def xmldatetime(dt):
     return dt.strftime("%Y-%m-%dT%H:%M:%S") + zprefix
 
 
+class HTMLTruncator(object):
+    """ truncate html to a number of text characters, closing all tags
+        still open at the cut. the output is xhtml: void elements are
+        closed, bare '&' and '<' are escaped, attribute values quoted and
+        implicitly closed elements (li, p, td, ...) closed explicitly.
+
+        >>> t = HTMLTruncator()
+        >>> t('<ul><li>one<li>two</ul>', 10, '...', False)
+        u'<ul><li>one</li><li>two</li></ul>'
+        >>> t('<dl><dt>a<dd>b<dt>c</dl>', 10, '...', False)
+        u'<dl><dt>a</dt><dd>b</dd><dt>c</dt></dl>'
+        >>> t('<table><tr><td>a<td>b<tr><td>c</table>', 10, '...', False)
+        u'<table><tr><td>a</td><td>b</td></tr><tr><td>c</td></tr></table>'
+        >>> t('<ul><li>a<ul><li>b</ul><li>c</ul>', 10, '...', False)
+        u'<ul><li>a<ul><li>b</li></ul></li><li>c</li></ul>'
+        >>> t('<p>one<p>two', 5, '...', False)
+        u'<p>one</p><p>tw...</p>'
+        >>> t('<a href=x.html title="a b" hidden>link</a>', 10, '...', False)
+        u'<a href="x.html" title="a b" hidden="hidden">link</a>'
+        >>> t('<div><p>a<div>b</div></div>', 10, '...', False)
+        u'<div><p>a</p><div>b</div></div>'
+        >>> t('<p>a<ul><li>b</ul>', 10, '...', False)
+        u'<p>a</p><ul><li>b</li></ul>'
+        >>> t('<script>if (a < b && c) {}</script><p>text', 2, '...', False)
+        u'<script>if (a < b && c) {}</script><p>te...</p>'
+        >>> t('<style>p > a { color: red }</style>ab', 10, '...', False)
+        u'<style>p > a { color: red }</style>ab'
+
+        results are kept in a lru memo, keyed by the sha1 of the input and
+        the arguments.
+    """
+
+    RE_TOKEN = re.compile(r'''<!--.*?-->|<!\[CDATA\[.*?\]\]>|<![^>]*>|'''
+                          r'''<script\b[^>]*>.*?</script\s*>|'''
+                          r'''<style\b[^>]*>.*?</style\s*>|'''
+                          r'''<(/?)([a-zA-Z][\w:.-]*)'''
+                          r'''((?:[^<>"']|"[^"]*"|'[^']*')*?)(/?)>|'''
+                          r'''&(?:#\d+|#x[0-9a-fA-F]+|\w+);''', re.S | re.I)
+    RE_SPACE = re.compile(r'\s+', re.U)
+    RE_ATTR = re.compile(r'''([^\s"'<>/=]+)(?:\s*=\s*'''
+                         r'''("[^"]*"|'[^']*'|[^\s"'<>=`]+))?''')
+    VOID = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img',
+                      'input', 'link', 'meta', 'param', 'source', 'wbr'))
+
+    # elements an open p can't be closed beyond
+    FLOW = frozenset(('div', 'li', 'td', 'th', 'dd', 'dt', 'blockquote',
+                      'section', 'article', 'aside', 'header', 'footer',
+                      'nav', 'main', 'form', 'body', 'table', 'button',
+                      'object', 'figure', 'details'))
+    # block elements, which close an open p
+    BLOCK = ('address', 'article', 'aside', 'blockquote', 'details', 'div',
+             'dl', 'fieldset', 'figure', 'footer', 'form', 'h1', 'h2', 'h3',
+             'h4', 'h5', 'h6', 'header', 'hr', 'main', 'menu', 'nav', 'ol',
+             'pre', 'section', 'table', 'ul')
+    # tag -> (tags closed by it, tags limiting the search for them)
+    IMPLIED = dict.fromkeys(BLOCK, (('p',), FLOW))
+    IMPLIED.update(li = (('li',), ('ul', 'ol', 'menu')),
+                   dt = (('dt', 'dd'), ('dl',)),
+                   dd = (('dt', 'dd'), ('dl',)),
+                   tr = (('tr',), ('table', 'thead', 'tbody', 'tfoot')),
+                   td = (('td', 'th'), ('tr', 'table')),
+                   th = (('td', 'th'), ('tr', 'table')),
+                   option = (('option',), ('select', 'optgroup',
+                                           'datalist')),
+                   p = (('p',), FLOW))
+
+    MEMO_SIZE = 4096
+
+    def __init__(self):
+        self.memo = collections.OrderedDict()
+
+    def __call__(self, s, length, end, words):
+        if isinstance(s, str):
+            s = s.decode('utf8')
+        key = (hashlib.sha1(s.encode('utf8')).hexdigest(), length, end,
+               words)
+        try:
+            result = self.memo.pop(key)
+        except KeyError:
+            result = self.truncate(s, length, end, words)
+        self.memo[key] = result
+        while len(self.memo) > self.MEMO_SIZE:
+            self.memo.popitem(last = False)
+        return result
+
+    def escape(self, text):
+        return text.replace('&', '&amp;').replace('<', '&lt;')
+
+    def attributes(self, attrs):
+        """ attrs with all values double quoted. attributes without
+            value get their name as value.
+        """
+        result = []
+        for name, value in self.RE_ATTR.findall(attrs):
+            name = name.lower()
+            if not value:
+                value = '"%s"' % name
+            elif value[0] not in '"\'':
+                value = '"%s"' % value
+            result.append(' %s=%s' % (name, value))
+        return ''.join(result)
+
+    def implied(self, tag, stack, out):
+        """ close the element implicitly closed by opening tag, i.e. an
+            open sibling of the same kind.
+        """
+        closes, scope = self.IMPLIED[tag]
+        for i in xrange(len(stack) - 1, -1, -1):
+            if stack[i] in closes:
+                while len(stack) > i:
+                    out.append('</%s>' % stack.pop())
+                return
+            if stack[i] in scope:
+                return
+
+    def truncate(self, s, length, end, words):
+        out = []
+        stack = []
+        left = length
+        pos = 0
+        for mo in itertools.chain(self.RE_TOKEN.finditer(s), [None]):
+            text = s[pos:mo.start() if mo else len(s)]
+            if len(text) > left:
+                cut = left
+                if words and not text[cut].isspace():
+                    # cut at the last word boundary. a word started in
+                    # an earlier text is dropped completely.
+                    spaces = [m.start() for m in
+                              self.RE_SPACE.finditer(text, 0, cut)]
+                    if spaces:
+                        cut = spaces[-1]
+                    elif left < length:
+                        cut = 0
+                text = text[:cut]
+                out.append(self.escape(text.rstrip() if words else text))
+                out.append(end)
+                break
+            out.append(self.escape(text))
+            left -= len(text)
+            if mo is None:
+                break
+            pos = mo.end()
+
+            close, tag, attrs, empty = mo.groups()
+            if tag is None:
+                if mo.group(0).startswith('&'):
+                    if left == 0:
+                        out.append(end)
+                        break
+                    left -= 1
+                out.append(mo.group(0))
+                continue
+            tag = tag.lower()
+            if close:
+                if tag in stack:
+                    # close all tags left open inside tag, too
+                    while stack:
+                        out.append('</%s>' % stack[-1])
+                        if stack.pop() == tag:
+                            break
+            else:
+                if tag in self.IMPLIED:
+                    self.implied(tag, stack, out)
+                if empty or tag in self.VOID:
+                    out.append('<%s%s />' % (tag, self.attributes(attrs)))
+                else:
+                    out.append('<%s%s>' % (tag, self.attributes(attrs)))
+                    stack.append(tag)
+
+        out.extend('</%s>' % tag for tag in reversed(stack))
+        return u''.join(out)
+
+htmlTruncator = HTMLTruncator()
+
+
 @templateFilter
-def xtruncate(s, length=255, end='...'):
-    import tidy
-
-    options = dict(output_xhtml=1,
-                   add_xml_decl=1,
-                   indent=1,
-                   show_body_only=1,
-                   tidy_mark=0)
-    return str(tidy.parseString(str(s[:length]) + end, **options))
+def xtruncate(s, length=255, end='...', words=False):
+    """ truncate the html s to length text characters (tags don't count)
+        and append end, if anything was cut. with words, only whole
+        words are kept.
+    """
+    return htmlTruncator(s, length, end, words)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+#
+# vim:syntax=python:sw=4:ts=4:expandtab
+#
+# Copyright (C) 2012 Rico Schiekel (fire at downgra dot de)
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License version 2
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+#
+
+""" generate synthetic sites and measure how long growl needs to build
+    them.
+
+    every scenario runs growl.py in a fresh process (so Site.prepare and
+    Site.run are measured exactly as on the command line) and records the
+    wall time and peak memory (rss) of that process:
+
+    * cold:   build without _deploy and _cache directories
+    * warm:   rebuild without any changes
+    * edit:   rebuild after changing a single post
+
+    e.g.
+
+        > bench/synthetic.py --posts 5000 --save baseline.json
+        > bench/synthetic.py --posts 5000 --compare baseline.json
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import tempfile
+import platform
+import subprocess
+from optparse import OptionParser
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GROWL = os.path.join(ROOT, 'growl.py')
+HOOKS = ('posts.py', )
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+
+def write(fname, content):
+    dirname = os.path.dirname(fname)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    f = open(fname, 'w')
+    f.write(content)
+    f.close()
+
+
+def markdown(rnd, paragraphs):
+    """ some random markdown text with the given number of paragraphs.
+    """
+    parts = []
+    for i in range(paragraphs):
+        words = [rnd.choice(WORDS) for _ in range(rnd.randint(40, 120))]
+        if i % 4 == 1:
+            parts.append('## ' + ' '.join(words[:4]))
+        if i % 5 == 2:
+            parts.append('\n'.join('* ' + w for w in words[:5]))
+        words[3] = '*%s*' % words[3]
+        words[7] = '**%s**' % words[7]
+        parts.append(' '.join(words))
+    return '\n\n'.join(parts) + '\n'
+
+
+def generate(path, opts):
+    """ generate a synthetic site below path.
+    """
+    rnd = random.Random(opts.seed)
+
+    for hook in HOOKS:
+        write(os.path.join(path, '_hooks', hook),
+              open(os.path.join(ROOT, '_hooks', hook)).read())
+    if opts.globals:
+        # a hook adding site wide template globals
+        write(os.path.join(path, '_hooks', 'globals.py'),
+              ''.join('Site.CONTEXT.global%d = %d\n' % (i, i)
+                      for i in range(opts.globals)))
+
+    # a chain of layouts: post -> layout1 -> ... -> base
+    chain = ['layout%d' % i for i in range(1, opts.layout_depth)]
+    parents = chain + ['base']
+    write(os.path.join(path, '_layout', 'base.html'),
+          '<html><head><title>{{ page.title or post.title }}</title>'
+          '</head>\n<body>\n{{ content }}\n</body></html>\n')
+    for name, parent in zip(chain, parents[1:]):
+        write(os.path.join(path, '_layout', name + '.html'),
+              '---\nlayout: %s\n---\n<div class="%s">{{ content }}</div>\n'
+              % (parent, name))
+    write(os.path.join(path, '_layout', 'post.html'),
+          '---\nlayout: %s\n---\n<h1>{{ post.title }}</h1>\n'
+          '<p>{{ post.date.strftime("%%Y-%%m-%%d") }}</p>\n{{ content }}\n'
+          % parents[0])
+
+    categories = ['category%d' % i for i in range(opts.categories)]
+    start = time.mktime((2005, 1, 1, 0, 0, 0, 0, 0, -1))
+    for i in range(opts.posts):
+        date = time.localtime(start + i * 86400 / 3)
+        cats = ', '.join(rnd.sample(categories, min(2, len(categories))))
+        write(os.path.join(path, '_posts', '%s-post-%d.markdown' %
+                                 (time.strftime('%Y-%m-%d', date), i)),
+              '---\nlayout: post\ntitle: post %d\ncategories: %s\n---\n%s'
+              % (i, cats, markdown(rnd, opts.paragraphs)))
+
+    write(os.path.join(path, 'index.html_'),
+          '---\nlayout: %s\ntitle: index\n---\n'
+          '{%% for post in (site.posts|reverse|list)[:10] %%}\n'
+          '{{ post.content }}\n{%% endfor %%}\n' % parents[0])
+    write(os.path.join(path, 'archive.html_'),
+          '---\nlayout: %s\ntitle: archive\n---\n<ul>\n'
+          '{%% for post in site.posts|reverse %%}'
+          '<li><a href="{{ post.url }}">{{ post.title }}</a></li>\n'
+          '{%% endfor %%}</ul>\n' % parents[0])
+    write(os.path.join(path, 'categories.html_'),
+          '---\nlayout: %s\ntitle: categories\n---\n'
+          '{%% for cat in site.categories %%}<h2>{{ cat }}</h2><ul>\n'
+          '{%% for post in site.categories[cat] %%}'
+          '<li><a href="{{ post.url }}">{{ post.title }}</a></li>\n'
+          '{%% endfor %%}</ul>{%% endfor %%}\n' % parents[0])
+    for i in range(opts.pages):
+        write(os.path.join(path, 'pages', 'page%d.markdown' % i),
+              '---\nlayout: %s\ntitle: page %d\n---\n%s'
+              % (parents[0], i, markdown(rnd, opts.paragraphs)))
+
+    for i in range(opts.assets):
+        write(os.path.join(path, 'static', 'asset%d.bin' % i),
+              os.urandom(opts.asset_size))
+
+
+def edit_post(path):
+    """ change the content of a single post.
+    """
+    posts = os.path.join(path, '_posts')
+    fname = os.path.join(posts, sorted(os.listdir(posts))[-1])
+    f = open(fname, 'a')
+    f.write('\nedited at %f\n' % time.time())
+    f.close()
+
+
+def build(path, args):
+    """ run growl on path. return wall time and peak rss (in kb).
+    """
+    devnull = open(os.devnull, 'w')
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, GROWL] + args + [path],
+                            stdout = devnull, stderr = devnull)
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    wall = time.time() - start
+    devnull.close()
+    if status != 0:
+        raise RuntimeError('growl failed on %s (status %d)' % (path, status))
+    return wall, rusage.ru_maxrss
+
+
+def run(path, opts, args):
+    results = {}
+
+    def measure(name, setup):
+        times = []
+        for i in range(opts.repeat):
+            setup()
+            times.append(build(path, args))
+        wall, rss = min(times)
+        results[name] = dict(wall = wall, rss = max(t[1] for t in times))
+        sys.stderr.write('%-6s %8.3fs %8d kb\n' % (name, wall,
+                                                   results[name]['rss']))
+
+    def clean():
+        for d in ('_deploy', '_cache'):
+            shutil.rmtree(os.path.join(path, d), True)
+
+    measure('cold', clean)
+    measure('warm', lambda: None)
+    measure('edit', lambda: edit_post(path))
+    return results
+
+
+def compare(results, baseline):
+    print '%-6s %10s %10s %8s' % ('', 'baseline', 'current', 'ratio')
+    for name in ('cold', 'warm', 'edit'):
+        if name not in baseline.get('results', {}):
+            continue
+        for key, unit in (('wall', 's'), ('rss', 'kb')):
+            old = baseline['results'][name][key]
+            new = results[name][key]
+            print '%-6s %9.3f%s %9.3f%s %7.2fx  (%s)' % (
+                            name, old, unit, new, unit,
+                            new / float(old or 1), key)
+
+
+def main():
+    parser = OptionParser(usage = 'syntax: %prog [options] [-- growl args]')
+    parser.add_option('--posts', type = 'int', default = 1000)
+    parser.add_option('--pages', type = 'int', default = 50)
+    parser.add_option('--categories', type = 'int', default = 20)
+    parser.add_option('--layout-depth', type = 'int', default = 3,
+                      dest = 'layout_depth')
+    parser.add_option('--paragraphs', type = 'int', default = 8,
+                      help = 'markdown paragraphs per post and page')
+    parser.add_option('--assets', type = 'int', default = 100)
+    parser.add_option('--asset-size', type = 'int', default = 64 * 1024,
+                      dest = 'asset_size')
+    parser.add_option('--globals', type = 'int', default = 0,
+                      help = 'add N site wide template globals by a hook')
+    parser.add_option('--seed', type = 'int', default = 42)
+    parser.add_option('--repeat', type = 'int', default = 1,
+                      help = 'run every scenario N times, report the best')
+    parser.add_option('--keep', metavar = 'DIR',
+                      help = 'generate the site in DIR and keep it')
+    parser.add_option('--save', metavar = 'FILE',
+                      help = 'save the results as json baseline')
+    parser.add_option('--compare', metavar = 'FILE',
+                      help = 'compare the results with a json baseline')
+    (opts, args) = parser.parse_args()
+
+    path = opts.keep or tempfile.mkdtemp(prefix = 'growl_bench_')
+    try:
+        if not os.path.isdir(os.path.join(path, '_posts')):
+            generate(path, opts)
+        results = run(path, opts, args)
+    finally:
+        if not opts.keep:
+            shutil.rmtree(path, True)
+
+    data = dict(params = dict((k, v) for k, v in vars(opts).items()
+                              if k not in ('keep', 'save', 'compare')),
+                growl_args = args,
+                python = platform.python_version(),
+                platform = platform.platform(),
+                time = time.strftime('%Y-%m-%dT%H:%M:%S'),
+                results = results)
+
+    if opts.compare:
+        baseline = json.load(open(opts.compare))
+        if baseline.get('params') != data['params']:
+            sys.stderr.write('warning: baseline was run with other '
+                             'parameters\n')
+        compare(results, baseline)
+
+    if opts.save:
+        f = open(opts.save, 'w')
+        json.dump(data, f, indent = 1, sort_keys = True)
+        f.close()
+
+
+if __name__ == '__main__':
+    main()
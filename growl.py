@@ -29,29 +29,399 @@ import os
 import sys
 import re
 import shutil
+import stat
 import datetime
 import time
 import collections
 import itertools
 import functools
 import inspect
+import types
+import hashlib
+import marshal
+import imp
+import tempfile
+import json
+import select
+import struct
+import errno
+import contextlib
+import threading
+from cStringIO import StringIO
 from optparse import OptionParser
 
 import yaml
 
+# prefer the fast libyaml based loader, if available
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class Profiler(object):
+    """ records wall and cpu time of the build phases and (if enabled)
+        of every transformed, rendered and written file, and counts cache
+        hits and misses.
+
+        the result can be saved as a json summary and as trace event file
+        for chrome://tracing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.clear()
+
+    def clear(self):
+        self.events = []
+        self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def span(self, name, fname = None):
+        """ time the enclosed block as phase name. if fname is given,
+            the block is only timed if the profiler is enabled.
+        """
+        if fname is not None and not self.enabled:
+            yield
+            return
+        wall, cpu = time.time(), time.clock()
+        try:
+            yield
+        finally:
+            self.events.append((name, fname, os.getpid(), wall,
+                                time.time() - wall, time.clock() - cpu))
+
+    def count(self, name, n = 1):
+        self.counters[name] += n
+
+    def take(self):
+        """ return and forget all events and counters.
+        """
+        result = self.events, self.counters
+        self.clear()
+        return result
+
+    def merge(self, events, counters):
+        self.events.extend(events)
+        self.counters.update(counters)
+
+    def exclusive(self):
+        """ return the wall and cpu time of every file event without the
+            time of events of the same name nested in it (e.g. posts
+            rendered while rendering a listing page).
+        """
+        result = {}
+        stacks = {}
+        for i, (name, fname, pid, start, wall, cpu) in sorted(
+                ((i, e) for i, e in enumerate(self.events) if e[1]),
+                key = lambda (i, e): (e[3], -e[4])):
+            stack = stacks.setdefault((pid, name), [])
+            while stack and stack[-1][0] <= start:
+                stack.pop()
+            if stack:
+                parent = result[stack[-1][1]]
+                parent[0] -= wall
+                parent[1] -= cpu
+            result[i] = [wall, cpu]
+            stack.append((start + wall, i))
+        return result
+
+    def summary(self):
+        """ per phase totals and per file timings. the totals of file
+            events don't include nested events of the same name.
+        """
+        phases = {}
+        files = {}
+        exclusive = self.exclusive()
+        for i, (name, fname, pid, start, wall, cpu) in enumerate(self.events):
+            if fname is not None:
+                p = files.setdefault((fname, name), dict(file = fname,
+                                                         phase = name,
+                                                         count = 0,
+                                                         wall = 0.0,
+                                                         cpu = 0.0))
+                p['count'] += 1
+                p['wall'] += wall
+                p['cpu'] += cpu
+                wall, cpu = exclusive[i]
+            p = phases.setdefault(name, dict(count = 0, wall = 0.0,
+                                             cpu = 0.0))
+            p['count'] += 1
+            p['wall'] += wall
+            p['cpu'] += cpu
+        return dict(phases = phases,
+                    files = sorted(files.values(), key = lambda f: -f['wall']),
+                    counters = dict(self.counters))
+
+    def trace(self):
+        t0 = min([e[3] for e in self.events] or [0])
+        return dict(traceEvents = [
+                        dict(name = name, cat = fname and 'file' or 'phase',
+                             ph = 'X', pid = pid, tid = pid,
+                             ts = int((start - t0) * 1e6),
+                             dur = int(wall * 1e6),
+                             args = dict(file = fname, cpu = cpu))
+                        for name, fname, pid, start, wall, cpu
+                        in self.events])
+
+    def save(self, prefix):
+        """ write <prefix>.json and <prefix>.trace.json.
+        """
+        dirname = os.path.dirname(prefix)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        for fname, data, indent in ((prefix + '.json', self.summary(), 1),
+                                    (prefix + '.trace.json', self.trace(),
+                                     None)):
+            f = file(fname, 'w')
+            json.dump(data, f, indent = indent)
+            f.close()
+            sys.stderr.write('profile written to %s\n' % fname)
+
+profiler = Profiler()
+
+
+class CacheDir(object):
+    """ a cache directory of at most MAX_SIZE bytes. entries are files,
+        their modification time is their last use.
+    """
+
+    MAX_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path, max_size = None):
+        self.path = path
+        self.max_size = max_size or self.MAX_SIZE
+        self.size = None
+
+    def added(self, size):
+        """ account for a new entry of size bytes, evict entries if the
+            cache grew too large.
+        """
+        if self.size is None:
+            self.size = sum(s for f, s, m in self.entries())
+        else:
+            self.size += size
+        if self.size > self.max_size:
+            self.prune()
+
+    def entries(self):
+        """ yield (filename, size, mtime) of all cache entries.
+        """
+        for root, dirs, files in os.walk(self.path):
+            for f in files:
+                fname = os.path.join(root, f)
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                yield fname, st.st_size, st.st_mtime
+
+    def prune(self):
+        """ evict least recently used entries, until the cache is
+            shrunk to 3/4 of its maximum size.
+        """
+        entries = sorted(self.entries(), key = lambda e: e[2])
+        self.size = sum(e[1] for e in entries)
+        for fname, size, mtime in entries:
+            if self.size <= self.max_size * 3 / 4:
+                break
+            try:
+                os.unlink(fname)
+                self.size -= size
+            except OSError:
+                pass
+
 
 def renderTemplate(template, context):
     raise NotImplementedError('no template engine configured!')
 
 
+def compileTemplate(template):
+    """ return a function rendering template with a given context.
+        template engines can override this to compile the template once.
+    """
+    return lambda context: renderTemplate(template, context)
+
+
+def streamTemplate(template):
+    """ like compileTemplate, but the returned function yields the
+        output in chunks. template engines able to stream their output
+        can override this.
+    """
+    render = compileTemplate(template)
+    return lambda context: iter([render(context)])
+
+
 try:
     import jinja2
 
     jinja2_env = jinja2.Environment()
 
+    class TemplateCache(object):
+        """ lru cache of compiled jinja2 templates, keyed by the sha1 of
+            the template source.
+
+            if the environment has a bytecode cache configured, the
+            compiled code is stored there too, so later runs can skip
+            the compilation.
+        """
+
+        SIZE = 512
+
+        def __init__(self, env, size = None):
+            self.env = env
+            self.size = size or self.SIZE
+            self.templates = collections.OrderedDict()
+
+        def get(self, source):
+            key = hashlib.sha1(source.encode('utf8')).hexdigest()
+            try:
+                tmpl = self.templates.pop(key)
+                profiler.count('template_cache.hit')
+            except KeyError:
+                profiler.count('template_cache.miss')
+                tmpl = self.compile(key, source)
+            self.templates[key] = tmpl
+            while len(self.templates) > self.size:
+                self.templates.popitem(last = False)
+            return tmpl
+
+        def compile(self, key, source):
+            bcc = self.env.bytecode_cache
+            if bcc is None:
+                return self.env.from_string(source)
+            bucket = bcc.get_bucket(self.env, key, None, source)
+            if bucket.code is None:
+                bucket.code = self.env.compile(source)
+                bcc.set_bucket(bucket)
+            return self.env.template_class.from_code(
+                        self.env, bucket.code, self.env.make_globals(None), None)
+
+        def clear(self):
+            self.templates.clear()
+
+    templateCache = TemplateCache(jinja2_env)
+
+    import jinja2.ext
+
+    class FragmentCacheExtension(jinja2.ext.Extension):
+        """ {% cache "name", dependency, ... %}...{% endcache %}
+
+            renders the enclosed fragment once and reuses it, until one of
+            the dependencies (or the fragment itself) changes. see
+            FragmentCache.
+        """
+
+        tags = set(['cache'])
+
+        def parse(self, parser):
+            lineno = next(parser.stream).lineno
+            name = parser.parse_expression()
+            deps = []
+            while parser.stream.skip_if('comma'):
+                deps.append(parser.parse_expression())
+            body = parser.parse_statements(['name:endcache'],
+                                           drop_needle = True)
+            # identifies the fragment source, so changed fragments aren't
+            # taken from the cache
+            ident = hashlib.sha1(repr(body)).hexdigest()
+            call = self.call_method('_cache', [name,
+                                               jinja2.nodes.Const(ident),
+                                               jinja2.nodes.List(deps)])
+            return jinja2.nodes.CallBlock(call, [], [],
+                                          body).set_lineno(lineno)
+
+        def _cache(self, name, ident, deps, caller):
+            return fragments.get(name, ident, deps, caller)
+
+    jinja2_env.add_extension(FragmentCacheExtension)
+
+    class AtomicBytecodeCache(CacheDir, jinja2.FileSystemBytecodeCache):
+        """ bytecode cache which replaces its files atomically, so
+            parallel workers never read partially written entries. every
+            post body is compiled, so the cache is limited in size like
+            the transform cache.
+        """
+
+        MAX_SIZE = 32 * 1024 * 1024
+
+        def __init__(self, directory, max_size = None):
+            jinja2.FileSystemBytecodeCache.__init__(self, directory)
+            CacheDir.__init__(self, directory, max_size)
+
+        def load_bytecode(self, bucket):
+            jinja2.FileSystemBytecodeCache.load_bytecode(self, bucket)
+            if bucket.code is not None:
+                try:
+                    os.utime(self._get_cache_filename(bucket), None)
+                except OSError:
+                    pass
+
+        def dump_bytecode(self, bucket):
+            fname = self._get_cache_filename(bucket)
+            fd, tmp = tempfile.mkstemp(dir = os.path.dirname(fname))
+            f = os.fdopen(fd, 'wb')
+            try:
+                bucket.write_bytecode(f)
+                size = f.tell()
+            finally:
+                f.close()
+            os.rename(tmp, fname)
+            self.added(size)
+
+    def jinja2Context(tmpl, context):
+        """ create the jinja2 context of tmpl. the shared parent of a
+            LayeredDict is used as parent of the jinja2 context as is,
+            only the items of the layers above it are copied.
+        """
+        if not isinstance(context, LayeredDict):
+            return tmpl.new_context(context)
+        items, parent = context.layers()
+        ctx = tmpl.new_context(parent, shared = True)
+        for name, value in tmpl.globals.iteritems():
+            if name not in parent:
+                ctx.vars[name] = value
+        for name, value in items.iteritems():
+            if value is LayeredDict.DELETED:
+                value = tmpl.globals.get(name, jinja2.utils.missing)
+            ctx.vars[name] = value
+        return ctx
+
+    def jinja2Render(tmpl, context):
+        """ like jinja2.Template.render, using jinja2Context.
+        """
+        ctx = jinja2Context(tmpl, context)
+        try:
+            return jinja2.utils.concat(tmpl.root_render_func(ctx))
+        except Exception:
+            return tmpl.environment.handle_exception()
+
+    def jinja2Generate(tmpl, context):
+        """ like jinja2.Template.generate, using jinja2Context.
+        """
+        ctx = jinja2Context(tmpl, context)
+        try:
+            for event in tmpl.root_render_func(ctx):
+                yield event
+        except Exception:
+            yield tmpl.environment.handle_exception()
+
     def renderTemplate(template, context):
         template = template.decode("utf8")
-        return jinja2_env.from_string(template).render(context)
+        return jinja2Render(templateCache.get(template), context)
+
+    jinja2RenderTemplate = renderTemplate
+
+    def compileTemplate(template):
+        if renderTemplate is not jinja2RenderTemplate:
+            # another template engine was configured by a hook
+            return lambda context: renderTemplate(template, context)
+        return functools.partial(jinja2Render,
+                                 templateCache.get(template.decode("utf8")))
+
+    def streamTemplate(template):
+        if renderTemplate is not jinja2RenderTemplate:
+            render = compileTemplate(template)
+            return lambda context: iter([render(context)])
+        return functools.partial(jinja2Generate,
+                                 templateCache.get(template.decode("utf8")))
 
     def templateFilter(func):
         """ decorator to easily create jinja2 filters
@@ -103,11 +473,734 @@ class AttrDict(dict):
         return AttrDict(super(AttrDict, self).copy())
 
 
+class LayeredDict(collections.MutableMapping):
+    """ copy-on-write template context: a layer of own items over a
+        parent mapping, which is shared and never modified. items set are
+        stored in the own layer, deleted ones are masked there. so copy()
+        only adds a new, empty layer, and setting up the context of a
+        page costs only its own items.
+
+        like AttrDict, the items are available as attributes.
+    """
+
+    DELETED = object()
+
+    def __init__(self, parent = None, items = ()):
+        object.__setattr__(self, '_parent', {} if parent is None else parent)
+        object.__setattr__(self, '_own', dict(items))
+
+    def __getitem__(self, name):
+        if name in self._own:
+            value = self._own[name]
+            if value is self.DELETED:
+                raise KeyError(name)
+            return value
+        return self._parent[name]
+
+    def __setitem__(self, name, value):
+        self._own[name] = value
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        if name in self._parent:
+            self._own[name] = self.DELETED
+        else:
+            del self._own[name]
+
+    def __contains__(self, name):
+        if name in self._own:
+            return self._own[name] is not self.DELETED
+        return name in self._parent
+
+    def get(self, name, default = None):
+        if name in self._own:
+            value = self._own[name]
+            return default if value is self.DELETED else value
+        return self._parent.get(name, default)
+
+    def __iter__(self):
+        for name, value in self._own.iteritems():
+            if value is not self.DELETED:
+                yield name
+        for name in self._parent:
+            if name not in self._own:
+                yield name
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __repr__(self):
+        return 'LayeredDict(%r)' % dict(self)
+
+    def copy(self):
+        return LayeredDict(self)
+
+    def layers(self):
+        """ return the items of all layers merged (masked ones as
+            DELETED) and the shared mapping below them.
+        """
+        layers = []
+        mapping = self
+        while isinstance(mapping, LayeredDict):
+            layers.append(mapping._own)
+            mapping = mapping._parent
+        items = {}
+        for own in reversed(layers):
+            items.update(own)
+        return items, mapping
+
+
+class SiteDict(AttrDict):
+    """ the site wide context object. item lookups are recorded in
+        `accessed` (if set), so the build graph knows which site
+        collections a page depends on.
+    """
+
+    accessed = None
+
+    def __getitem__(self, name):
+        if SiteDict.accessed is not None:
+            SiteDict.accessed.add(name)
+        return super(SiteDict, self).__getitem__(name)
+
+    def copy(self):
+        return SiteDict(super(SiteDict, self).copy())
+
+
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def writeFile(fname, data):
+    """ atomically replace fname with data (using a temporary file and a
+        rename), unless the file already has exactly this content.
+        return true, if the file was written.
+    """
+    try:
+        if os.path.getsize(fname) == len(data):
+            f = file(fname, 'rb')
+            try:
+                if f.read() == data:
+                    return False
+            finally:
+                f.close()
+    except (IOError, OSError):
+        pass
+
+    dirname = os.path.dirname(fname)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmp = tempfile.mkstemp(dir = dirname,
+                               prefix = '.%s.' % os.path.basename(fname))
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.chmod(tmp, 0666 & ~UMASK)
+        os.rename(tmp, fname)
+    except:
+        os.unlink(tmp)
+        raise
+    return True
+
+
+def encodeChunks(chunks, size = 64 * 1024):
+    """ utf8 encode the unicode chunks, joining small ones (as yielded by
+        template engines) to blocks of about size characters.
+    """
+    buf = []
+    buffered = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield u''.join(buf).encode('utf8')
+            buf = []
+            buffered = 0
+    if buf:
+        yield u''.join(buf).encode('utf8')
+
+
+def writeStream(fname, chunks):
+    """ like writeFile, but write the byte strings yielded by chunks, so
+        the content never has to be held in memory. the existing file is
+        compared on the fly, and a temporary file is only created, once
+        the content differs.
+        return whether the file was written and the sha1 of the content.
+    """
+    h = hashlib.sha1()
+    try:
+        old = file(fname, 'rb')
+    except IOError:
+        old = None
+    same = 0
+    out = tmp = None
+    try:
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is not None:
+                h.update(chunk)
+                if out is None and old is not None and \
+                        old.read(len(chunk)) == chunk:
+                    same += len(chunk)
+                    continue
+            elif out is None and old is not None and not old.read(1):
+                return False, h.hexdigest()
+
+            if out is None:
+                dirname = os.path.dirname(fname)
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                fd, tmp = tempfile.mkstemp(dir = dirname, prefix = '.%s.' %
+                                           os.path.basename(fname))
+                out = os.fdopen(fd, 'wb')
+                if same:
+                    # the equal prefix is taken from the existing file
+                    old.seek(0)
+                    while same:
+                        data = old.read(min(same, 64 * 1024))
+                        out.write(data)
+                        same -= len(data)
+            if chunk is not None:
+                out.write(chunk)
+
+        out.close()
+        os.chmod(tmp, 0666 & ~UMASK)
+        os.rename(tmp, fname)
+    except:
+        if out is not None:
+            out.close()
+            os.unlink(tmp)
+        raise
+    finally:
+        if old is not None:
+            old.close()
+    return True, h.hexdigest()
+
+
+def libc():
+    """ return the c library, loaded via ctypes.
+    """
+    if libc.handle is None:
+        import ctypes
+        import ctypes.util
+        libc.handle = ctypes.CDLL(ctypes.util.find_library('c'),
+                                  use_errno = True)
+    return libc.handle
+libc.handle = None
+
+
+def copyData(fsrc, fdst):
+    """ copy the content of file object fsrc to fdst. tries to clone the
+        data (reflink) first, then a kernel side copy using sendfile and
+        finally falls back to copying through python.
+    """
+    try:
+        import fcntl
+        fcntl.ioctl(fdst.fileno(), copyData.FICLONE, fsrc.fileno())
+        return
+    except (ImportError, IOError, OSError):
+        pass
+
+    try:
+        import ctypes
+        sendfile = libc().sendfile
+        sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                             ctypes.c_size_t]
+        sendfile.restype = ctypes.c_ssize_t
+    except (OSError, AttributeError):
+        sendfile = None
+
+    if sendfile is not None:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            sent = sendfile(fdst.fileno(), fsrc.fileno(), None,
+                            min(remaining, 0x7ffff000))
+            if sent <= 0:
+                break
+            remaining -= sent
+        if remaining <= 0:
+            return
+        if sent < 0 and ctypes.get_errno() not in (errno.EINVAL,
+                                                   errno.ENOSYS):
+            raise OSError(ctypes.get_errno(), 'sendfile failed')
+
+    shutil.copyfileobj(fsrc, fdst)
+copyData.FICLONE = 0x40049409
+
+
+def syncFile(src, dst, link = False):
+    """ make dst a copy of src, unless size and modification time already
+        match. if link is true, dst becomes a hardlink to src (if the
+        filesystem supports it). the copy is atomically moved into place.
+        return true, if dst was updated.
+    """
+    st = os.stat(src)
+    try:
+        dt = os.stat(dst)
+        if (dt.st_size == st.st_size and
+                abs(dt.st_mtime - st.st_mtime) < 0.001):
+            return False
+    except OSError:
+        pass
+
+    dirname = os.path.dirname(dst)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmp = tempfile.mkstemp(dir = dirname,
+                               prefix = '.%s.' % os.path.basename(dst))
+    try:
+        fdst = os.fdopen(fd, 'wb')
+        try:
+            if link:
+                os.unlink(tmp)
+                try:
+                    os.link(src, tmp)
+                    os.rename(tmp, dst)
+                    return True
+                except OSError:
+                    # no hardlinks here, so copy the file instead
+                    fdst = file(tmp, 'wb')
+            fsrc = file(src, 'rb')
+            try:
+                copyData(fsrc, fdst)
+            finally:
+                fsrc.close()
+        finally:
+            fdst.close()
+        os.chmod(tmp, stat.S_IMODE(st.st_mode))
+        os.utime(tmp, (st.st_atime, st.st_mtime))
+        os.rename(tmp, dst)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return True
+
+
+class Compressor(object):
+    """ write precompressed siblings (`.gz` and, if the brotli module is
+        available, `.br`) of text files in the deploy directory. files are
+        only compressed, if their content changed or a sibling is missing.
+    """
+
+    MIN_SIZE = 256
+    LEVEL = 9
+    BROTLI_QUALITY = 11
+    TYPES = ('text/', 'application/javascript', 'application/x-javascript',
+             'application/json', 'application/xml', 'application/atom+xml',
+             'application/rss+xml', 'image/svg+xml')
+
+    def __init__(self):
+        self.enabled = False
+        self.pending = []
+        self.formats = [('.gz', self.gzip)]
+        try:
+            import brotli
+            self.formats.append(('.br', lambda data: brotli.compress(
+                                        data, quality = self.BROTLI_QUALITY)))
+        except ImportError:
+            pass
+
+    def compressible(self, fname):
+        import mimetypes
+        ctype = mimetypes.guess_type(fname)[0] or ''
+        return ctype.startswith(self.TYPES)
+
+    def add(self, fname, changed = True, text = False):
+        """ queue fname for compression. text files are always
+            compressible, otherwise the mime type of fname is checked.
+        """
+        if not self.enabled or not (text or self.compressible(fname)):
+            return
+        if not changed:
+            try:
+                mtime = os.stat(fname).st_mtime
+                if all(os.stat(fname + ext).st_mtime >= mtime
+                       for ext, func in self.formats):
+                    return
+            except OSError:
+                if os.path.getsize(fname) < self.MIN_SIZE:
+                    return
+        self.pending.append(fname)
+
+    def flush(self, jobs = 1):
+        """ compress all queued files, using `jobs` threads.
+        """
+        pending, self.pending = self.pending, []
+        if jobs > 1 and len(pending) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(jobs)
+            try:
+                pool.map(self.compress, pending)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for fname in pending:
+                self.compress(fname)
+        return len(pending)
+
+    def compress(self, fname):
+        with profiler.span('compress_file', fname):
+            f = file(fname, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            for ext, func in self.formats:
+                if len(data) >= self.MIN_SIZE:
+                    cdata = func(data)
+                    if writeFile(fname + ext, cdata) and \
+                            Config.deploy_manifest is not None:
+                        Config.deploy_manifest.record(
+                                fname + ext, hashlib.sha1(cdata).hexdigest())
+                elif os.path.exists(fname + ext):
+                    os.unlink(fname + ext)
+
+    def gzip(self, data):
+        import gzip
+        buf = StringIO()
+        f = gzip.GzipFile('', 'wb', self.LEVEL, buf, mtime = 0)
+        f.write(data)
+        f.close()
+        return buf.getvalue()
+
+compressor = Compressor()
+
+
+class LazyTransformer(object):
+    """ a transformer, whose module is only imported, when the first file
+        is transformed. extra arguments are bound to the function.
+
+        Config.transformers['markdown'] = LazyTransformer('markdown',
+                                                          'markdown')
+    """
+
+    def __init__(self, module, name, *args, **kwargs):
+        self.module = module
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.func = None
+
+    @staticmethod
+    def available(module):
+        """ return true, if the (top level) module can be imported. the
+            module is only searched, not loaded.
+        """
+        try:
+            f = imp.find_module(module)[0]
+        except ImportError:
+            return False
+        if f is not None:
+            f.close()
+        return True
+
+    def resolve(self):
+        if self.func is None:
+            mod = __import__(self.module, fromlist = [self.name])
+            func = getattr(mod, self.name)
+            if self.args or self.kwargs:
+                func = functools.partial(func, *self.args, **self.kwargs)
+            self.func = func
+        return self.func
+
+    def __call__(self, source):
+        return self.resolve()(source)
+
+
+def transformerId(func):
+    """ return a string identifying a transformer function, its bound
+        arguments (for functools.partial) and the version of its module.
+    """
+    if isinstance(func, LazyTransformer):
+        func = func.resolve()
+    parts = []
+    while isinstance(func, functools.partial):
+        parts.append(repr((func.args, sorted((func.keywords or {}).items()))))
+        func = func.func
+
+    module = getattr(func, '__module__', None) or ''
+    mod = sys.modules.get(module.split('.')[0])
+    version = (getattr(mod, '__version__', None) or
+               getattr(mod, 'version', None) or '')
+    ident = '%s.%s:%s' % (module, getattr(func, '__name__', repr(func)),
+                          version)
+
+    # lambdas and functions defined in hooks all share the same module,
+    # so also take their code into account.
+    code = getattr(func, '__code__', None)
+    if code is not None:
+        sha1 = hashlib.sha1()
+        codeDigest(code, sha1)
+        ident += ':' + sha1.hexdigest()
+    return '|'.join([ident] + parts)
+
+
+def codeDigest(code, sha1):
+    """ feed the byte code, names and constants of code into sha1,
+        including nested functions, lambdas and generator expressions.
+        unlike the repr of a code object, this doesn't depend on its
+        address, so it's the same in every process.
+    """
+    sha1.update(code.co_code)
+    sha1.update(repr(code.co_names))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            sha1.update('<code>')
+            codeDigest(const, sha1)
+        else:
+            sha1.update(repr(const))
+
+
+class TransformCache(CacheDir):
+    """ persistent, content addressed cache for transformer output.
+
+        entries are keyed by the sha1 of the transformer identity (see
+        transformerId) and the source text. if the cache grows beyond
+        MAX_SIZE bytes, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, max_size = None):
+        super(TransformCache, self).__init__(path, max_size)
+        self.ids = {}
+
+    def key(self, func, source):
+        tid = self.ids.get(func)
+        if tid is None:
+            tid = self.ids[func] = transformerId(func)
+        if isinstance(source, unicode):
+            source = source.encode('utf8')
+        return hashlib.sha1(tid + '\0' + source).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def get(self, func, source):
+        """ return func(source), reusing a stored result if possible.
+        """
+        fname = self.filename(self.key(func, source))
+        try:
+            f = file(fname, 'rb')
+            try:
+                result = marshal.load(f)
+            finally:
+                f.close()
+            os.utime(fname, None)
+            profiler.count('transform_cache.hit')
+            return result
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+
+        profiler.count('transform_cache.miss')
+        result = func(source)
+        self.store(fname, result)
+        return result
+
+    def store(self, fname, result):
+        try:
+            data = marshal.dumps(result)
+        except ValueError:
+            return
+        dirname = os.path.dirname(fname)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd, tmp = tempfile.mkstemp(dir = dirname)
+            os.write(fd, data)
+            os.close(fd)
+            os.rename(tmp, fname)
+        except (IOError, OSError):
+            return
+        self.added(len(data))
+
+
+class FragmentCache(object):
+    """ rendered template fragments (see FragmentCacheExtension).
+
+        fragments are keyed by their name and source, and stored together
+        with the fingerprint of their dependencies, computed by the build
+        graph. within a build, every fragment is rendered at most once per
+        fingerprint, across builds it's reused from the cache directory
+        as long as the fingerprint doesn't change.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.graph = None
+        self.clear()
+
+    def clear(self):
+        """ forget the fragments and fingerprints of the last build.
+        """
+        self.fragments = {}
+        self.fingerprints = {}
+
+    def fingerprint(self, deps):
+        fps = []
+        for value in deps:
+            # keep the value, so its id isn't reused within this build
+            memo = self.fingerprints.get(id(value))
+            if memo is None or memo[0] is not value:
+                memo = (value, self.graph.fingerprint(value))
+                self.fingerprints[id(value)] = memo
+            fps.append(memo[1])
+        return ':'.join(fps)
+
+    def get(self, name, ident, deps, render):
+        """ return the fragment name, calling render if it's not cached.
+        """
+        fp = self.fingerprint(deps) if self.graph is not None else None
+        key = (name, ident, fp)
+        result = self.fragments.get(key)
+        if result is not None:
+            profiler.count('fragment_cache.hit')
+            return result
+
+        fname = None
+        if self.path and fp is not None:
+            h = hashlib.sha1(repr((name, ident))).hexdigest()
+            fname = os.path.join(self.path, h[:2], h[2:])
+            try:
+                f = file(fname, 'rb')
+                try:
+                    stored, result = marshal.load(f)
+                finally:
+                    f.close()
+                if stored != fp:
+                    result = None
+            except (IOError, EOFError, ValueError, TypeError):
+                result = None
+
+        if result is None:
+            profiler.count('fragment_cache.miss')
+            result = unicode(render())
+            if fname is not None:
+                try:
+                    if not os.path.isdir(os.path.dirname(fname)):
+                        os.makedirs(os.path.dirname(fname))
+                    writeFile(fname, marshal.dumps((fp, result)))
+                except (IOError, OSError):
+                    pass
+        else:
+            profiler.count('fragment_cache.hit')
+        self.fragments[key] = result
+        return result
+
+fragments = FragmentCache()
+
+
+class DeployManifest(object):
+    """ content hashes of all files in the deploy directory, used to
+        upload only changed files on deploy.
+
+        entries map the path (relative to the deploy directory) to its
+        mtime, size and sha1. they are recorded as files are written and
+        validated by mtime and size on refresh, so files which changed by
+        other means (e.g. copied static files) are hashed again.
+    """
+
+    def __init__(self, filename, root):
+        self.filename = filename
+        self.root = root
+        self._entries = None
+        # in worker processes, records are collected here and passed to
+        # the parent (see writePending)
+        self.recorded = None
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = self.load(self.filename)
+        return self._entries
+
+    @staticmethod
+    def load(filename):
+        try:
+            f = file(filename, 'rb')
+            try:
+                return json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return {}
+
+    @staticmethod
+    def dump(filename, entries):
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        writeFile(filename, json.dumps(entries, sort_keys = True))
+
+    def record(self, fname, digest = None):
+        """ record the content hash (sha1 hexdigest) of fname. if digest
+            is not given, the file is read.
+        """
+        if self.recorded is not None:
+            self.recorded.append((fname, digest))
+            return
+        path = os.path.relpath(fname, self.root)
+        try:
+            st = os.stat(fname)
+            if digest is None:
+                h = hashlib.sha1()
+                f = file(fname, 'rb')
+                try:
+                    for data in iter(lambda: f.read(64 * 1024), ''):
+                        h.update(data)
+                finally:
+                    f.close()
+                digest = h.hexdigest()
+        except (IOError, OSError):
+            self.entries.pop(path, None)
+            return
+        self.entries[path] = [st.st_mtime, st.st_size, digest]
+
+    def refresh(self):
+        """ bring the manifest in sync with the deploy directory and
+            return the entries.
+        """
+        entries = self.entries
+        found = set()
+        for root, dirs, files in os.walk(self.root):
+            for f in files:
+                fname = os.path.join(root, f)
+                path = os.path.relpath(fname, self.root)
+                found.add(path)
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                entry = entries.get(path)
+                if entry is None or entry[0] != st.st_mtime or \
+                        entry[1] != st.st_size:
+                    self.record(fname)
+        for path in set(entries) - found:
+            del entries[path]
+        return entries
+
+    def save(self):
+        if self._entries is not None:
+            self.dump(self.filename, self._entries)
+
+
 class Config(object):
     """ base class providing some static configuration values.
     """
 
-    LIB_DIR = HOOK_DIR = ''
+    LIB_DIR = HOOK_DIR = CACHE_DIR = DEPLOY_DIR = ''
+    transform_cache = deploy_manifest = None
 
     @classmethod
     def updateconfig(cls, base, deploy):
@@ -117,6 +1210,12 @@ class Config(object):
         cls.LAYOUT_DIR = os.path.join(base, '_layout')
         cls.HOOK_DIR = os.path.join(base, '_hooks')
         cls.LIB_DIR = os.path.join(base, '_libs')
+        cls.CACHE_DIR = os.path.join(base, '_cache')
+        cls.transform_cache = TransformCache(os.path.join(cls.CACHE_DIR,
+                                                          'transform'))
+        cls.deploy_manifest = DeployManifest(os.path.join(cls.CACHE_DIR,
+                                                          'deploy.json'),
+                                             deploy)
         cls.POST_FILE_EXT = '.html'
         cls.ARTICLE_FILE_EXT = '.html'
 
@@ -130,44 +1229,151 @@ class Template(Config):
 
     RE_YAML = re.compile(r'(^---\s*$(?P<yaml>.*?)^---\s*$)?(?P<content>.*)',
                          re.M | re.S)
+    RE_MARKER = re.compile(r'---\s*$')
+
+    # filename -> ((mtime, size), header, content offset)
+    HEADERS = {}
+
+    # number of templates which keep their transformed and rendered content
+    MEMO_SIZE = 1024
+    MEMO = collections.OrderedDict()
 
     def __init__(self, filename, layouts, context):
         super(Template, self).__init__()
         self.filename = filename
         self.layouts = layouts
-        self.context = context.copy()
+        self.context = LayeredDict(context)
         self.context.layout = None
         self.read_yaml()
 
     def read_yaml(self):
         """ read yaml header and remove the header from content
         """
-        self._content = file(self.filename, 'r').read()
+        self.release()
+        header, self._offset = self.read_header()
+
+        if header:
+            self.context.update(header)
 
-        mo = self.RE_YAML.match(self._content)
+    @property
+    def _content(self):
+        """ the content without the yaml header. it's read from disk on
+            demand, so only templates being rendered hold their content.
+        """
+        f = file(self.filename, 'r')
+        try:
+            f.seek(self._offset)
+            return f.read()
+        finally:
+            f.close()
+
+    def memoize(self):
+        """ mark the memoized content of this template as recently used.
+            the least recently used templates beyond MEMO_SIZE release
+            their content again.
+        """
+        memo = Template.MEMO
+        memo.pop(id(self), None)
+        memo[id(self)] = self
+        while len(memo) > self.MEMO_SIZE:
+            memo.popitem(last = False)[1].release()
+
+    def release(self):
+        """ forget the memoized transformed and rendered content.
+        """
+        self._transformed = self._rendered = self._accessed = None
+        Template.MEMO.pop(id(self), None)
+
+    def read_header(self):
+        """ parse the yaml header of the file and return it together
+            with the offset of the content. only the header is read, and
+            parsed headers are cached as long as the file doesn't change,
+            then the file isn't even opened.
+        """
+        st = os.stat(self.filename)
+        stamp = (st.st_mtime, st.st_size)
+        cached = self.HEADERS.get(self.filename)
+        if cached and cached[0] == stamp:
+            return cached[1:]
+
+        # collect the header, the closing marker and the following blank
+        # lines (RE_YAML eats some of them), up to the first content line
+        f = file(self.filename, 'r')
+        try:
+            head = line = f.readline()
+            if self.RE_MARKER.match(line):
+                closed = False
+                while line:
+                    line = f.readline()
+                    head += line
+                    if closed and line.strip():
+                        break
+                    closed = closed or bool(self.RE_MARKER.match(line))
+        finally:
+            f.close()
+
+        header, offset = None, 0
+        mo = self.RE_YAML.match(head)
         if mo and mo.groupdict().get('yaml'):
-            self.context.update(yaml.load(mo.groupdict().get('yaml')))
-            self._content = mo.groupdict().get('content')
+            header = yaml.load(mo.groupdict().get('yaml'),
+                               Loader = YAML_LOADER)
+            offset = mo.start('content')
+
+        self.HEADERS[self.filename] = (stamp, header, offset)
+        return header, offset
 
     def transform(self):
         """ do transformation based on filename extension.
             e.g. do markdown or textile transformations
         """
-        ext = os.path.splitext(self.filename)[-1][1:]
-        t = self.transformers.get(ext, lambda x: x)
-        return t(self._content)
+        self.memoize()
+        if self._transformed is None:
+            with profiler.span('transform', self.filename):
+                ext = os.path.splitext(self.filename)[-1][1:]
+                t = self.transformers.get(ext)
+                if t is None:
+                    self._transformed = self._content
+                elif self.transform_cache is None:
+                    self._transformed = t(self._content)
+                else:
+                    self._transformed = self.transform_cache.get(
+                                                    t, self._content)
+        return self._transformed
 
     def render(self):
         """ render content, so transforming and then
             apply current layout.
+
+            the result is kept until the source is read again (or the
+            template is released, see memoize), as listing pages may
+            render the same post many times per build. the site items
+            looked up while rendering are kept too, and recorded again
+            (see SiteDict) whenever the kept result is used.
         """
-        ctx = self.context.copy()
-        ctx.content = renderTemplate(self.transform(), ctx)
-        layout = self.layouts.get(ctx.layout)
-        if layout:
-            return renderTemplate(layout.content, ctx)
-        else:
-            return ctx.content
+        self.memoize()
+        if self._rendered is not None:
+            profiler.count('render_memo.hit')
+            if SiteDict.accessed is not None:
+                SiteDict.accessed.update(self._accessed)
+            return self._rendered
+
+        profiler.count('render_memo.miss')
+        content = self.transform()
+        outer, SiteDict.accessed = SiteDict.accessed, set()
+        try:
+            with profiler.span('render', self.filename):
+                ctx = self.context.copy()
+                ctx.content = renderTemplate(content, ctx)
+                layout = self.layouts.get(ctx.layout)
+                if layout:
+                    self._rendered = layout.pipeline(self.layouts)[0](ctx)
+                else:
+                    self._rendered = ctx.content
+        finally:
+            self._accessed, SiteDict.accessed = SiteDict.accessed, outer
+            if outer is not None:
+                outer.update(self._accessed)
+        return self._rendered
 
     def layout(self):
         """ layout content, so transforming and then applying
@@ -177,24 +1383,42 @@ class Template(Config):
         ctx.content = self.render()
         layout = self.layouts.get(ctx.layout)
         if layout:
-            layout = self.layouts.get(layout.layout)
-
-        while layout != None:
-            ctx.content = renderTemplate(layout.content, ctx)
-            layout = self.layouts.get(layout.layout)
+            with profiler.span('layout', self.filename):
+                for render in layout.pipeline(self.layouts)[1:]:
+                    ctx.content = render(ctx)
 
         return ctx.content
 
+    def stream(self):
+        """ like layout, but return an iterator over chunks of the
+            content. the outermost layout isn't rendered to a string, but
+            streamed, while the content is written.
+        """
+        ctx = self.context.copy()
+        ctx.content = self.render()
+        layout = self.layouts.get(ctx.layout)
+        if not layout or len(layout.pipeline(self.layouts)) < 2:
+            return iter([ctx.content])
+        with profiler.span('layout', self.filename):
+            for render in layout.pipeline(self.layouts)[1:-1]:
+                ctx.content = render(ctx)
+        return layout.stream(self.layouts)(ctx)
+
     def write(self, path, content):
-        """ write content to path in deploy directory.
+        """ write content (a string or an iterator over chunks of it) to
+            path in deploy directory. files which already have this
+            content are left untouched.
+            return true, if the file was written.
         """
         fname = os.path.join(self.DEPLOY_DIR, path)
-        dirname = os.path.dirname(fname)
-        if not os.path.isdir(dirname):
-            os.makedirs(dirname)
-        f = file(fname, 'w')
-        f.write(content.encode("utf8"))
-        f.close()
+        if isinstance(content, basestring):
+            content = [content]
+        with profiler.span('write', fname):
+            written, digest = writeStream(fname, encodeChunks(content))
+        if written and self.deploy_manifest is not None:
+            self.deploy_manifest.record(fname, digest)
+        compressor.add(fname, written, text = True)
+        return written
 
     def __getattr__(self, name):
         if not name in self.context:
@@ -206,6 +1430,13 @@ class Template(Config):
     def transformed(self):
         return self.transform()
 
+    def inputs(self):
+        """ values, besides its files and the site items, the output of
+            this template depends on. they are fingerprinted by the build
+            graph.
+        """
+        return {}
+
 
 class Layout(Template):
     """ a layout template from _layouts/ directory.
@@ -217,11 +1448,35 @@ class Layout(Template):
         base = os.path.basename(filename)
         ext = os.path.splitext(base)
         self.name = ext[0]
+        self.chain = self.streamer = None
 
     @property
     def layout(self):
         return self.context.get('layout')
 
+    def pipeline(self, layouts):
+        """ return the compiled templates of this layout and all its
+            parent layouts. the chain is only resolved once.
+        """
+        if self.chain is None:
+            self.chain = []
+            seen = set()
+            layout = self
+            while layout is not None and layout.name not in seen:
+                seen.add(layout.name)
+                self.chain.append(compileTemplate(layout.content))
+                outermost = layout
+                layout = layouts.get(layout.layout)
+            self.streamer = streamTemplate(outermost.content)
+        return self.chain
+
+    def stream(self, layouts):
+        """ return the outermost layout of the chain as function yielding
+            chunks of its output (see streamTemplate).
+        """
+        self.pipeline(layouts)
+        return self.streamer
+
     @property
     def content(self):
         return self.transform()
@@ -267,7 +1522,7 @@ class Page(Template):
         return self.render()
 
     def write(self):
-        return super(Page, self).write(self.path, self.layout())
+        return super(Page, self).write(self.path, self.stream())
 
     @staticmethod
     def transformable(filename):
@@ -280,6 +1535,429 @@ class Page(Template):
                 (ext and ext[1:] in Page.transformers))
 
 
+class BuildGraph(Config):
+    """ records for every generated output the files (source, layout chain
+        and referenced templates) and site collections it depends on.
+
+        the graph is saved as a manifest between runs, so only outputs
+        whose inputs changed have to be generated again.
+    """
+
+    RE_REFS = re.compile(r'''{%-?\s*(?:extends|include|import|from)\s+'''
+                         r'''["']([^"']+)["']''')
+
+    # site items which change on every run, but are not worth a rebuild
+    VOLATILE = ('now', )
+
+    def __init__(self, filename):
+        super(BuildGraph, self).__init__()
+        self.filename = filename
+        self.force = False
+        self.outputs = {}
+        self.reset()
+        self.load()
+
+    def load(self):
+        """ load the manifest. it's loaded right after the hooks were
+            executed, the fingerprint of the globals is kept from then on:
+            outputs generated by the loaded hooks must not be saved under
+            the fingerprint of hooks edited later (e.g. with --daemon).
+        """
+        self.previous = {}
+        # fname -> [stamp, referenced templates]
+        self.scanned = {}
+        self.dirty = False
+        self.loaded_globals = self.globals()
+        try:
+            data = json.load(file(self.filename, 'r'))
+            if data.get('globals') == self.loaded_globals:
+                self.previous = data.get('outputs', {})
+            self.scanned = data.get('refs', {})
+        except (IOError, ValueError):
+            pass
+
+    def save(self):
+        """ save the manifest, if any output was generated or any file
+            was scanned for references in this run. outputs which were not
+            generated, but are still up to date, are kept.
+        """
+        if not self.outputs and not self.dirty:
+            return
+        dirname = os.path.dirname(self.filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.previous.update(self.outputs)
+        self.outputs = {}
+        self.scanned = dict((f, self.scanned[f]) for f in self.refs
+                            if f in self.scanned)
+        self.dirty = False
+        writeFile(self.filename, json.dumps(dict(globals = self.loaded_globals,
+                                                 outputs = self.previous,
+                                                 refs = self.scanned)))
+
+    def reset(self, changed = None):
+        """ forget all per run state, e.g. before each autoreload cycle.
+            if the set of changed paths is known, only their state is
+            forgotten.
+        """
+        if changed is None:
+            self.stamps = {}
+            self.refs = {}
+            self.deps = {}
+            self.fingerprints = {}
+            return
+        for path in changed:
+            self.stamps.pop(path, None)
+            self.refs.pop(path, None)
+        # a changed layout may change the layout chain of any template
+        layouts = os.path.join(self.LAYOUT_DIR, '')
+        if any(path.startswith(layouts) for path in changed):
+            self.deps = {}
+        else:
+            self.deps = dict((key, state) for key, state
+                             in self.deps.iteritems()
+                             if not changed.intersection(state[0]))
+        # collection fingerprints are kept, unless one of their member
+        # files changed. a changed file which isn't a member of any
+        # collection may add to any of them (e.g. a new post), and
+        # collections without member files may be derived from anything.
+        members = set()
+        for fp, files in self.fingerprints.itervalues():
+            members.update(files)
+        if not changed <= members:
+            self.fingerprints = {}
+        else:
+            self.fingerprints = dict((name, (fp, files)) for name, (fp, files)
+                                     in self.fingerprints.iteritems()
+                                     if files and not changed & files)
+
+    def globals(self):
+        """ fingerprint of everything all outputs depend on, e.g. the
+            growl version and the hooks.
+        """
+        hooks = []
+        if os.path.isdir(self.HOOK_DIR):
+            hooks = sorted(os.path.join(self.HOOK_DIR, f)
+                           for f in os.listdir(self.HOOK_DIR))
+        return [__version__, os.path.abspath(self.DEPLOY_DIR),
+                [[f, self.stamp(f)] for f in hooks]]
+
+    def stamp(self, fname):
+        if fname not in self.stamps:
+            try:
+                st = os.stat(fname)
+                self.stamps[fname] = [st.st_mtime, st.st_size]
+            except OSError:
+                self.stamps[fname] = None
+        return self.stamps[fname]
+
+    def references(self, fname):
+        """ templates referenced by extends, include, import or from.
+            files are only scanned again, if their stamp changed since
+            the last run.
+        """
+        if fname not in self.refs:
+            stamp = self.stamp(fname)
+            scanned = self.scanned.get(fname)
+            if scanned is None or scanned[0] != stamp:
+                try:
+                    content = file(fname, 'r').read()
+                except IOError:
+                    content = ''
+                scanned = [stamp, [os.path.join(self.LAYOUT_DIR, r)
+                                   for r in self.RE_REFS.findall(content)]]
+                self.scanned[fname] = scanned
+                self.dirty = True
+            self.refs[fname] = scanned[1]
+        return self.refs[fname]
+
+    def files(self, tmpl):
+        """ all files a template depends on: its source, its layout
+            chain and all templates referenced from them.
+        """
+        return self.state(tmpl)[0]
+
+    def state(self, tmpl):
+        """ return the files of tmpl (see files) and the stamps of them
+            as string, which is kept until one of the files changes.
+        """
+        key = (tmpl.filename, tmpl.context.get('layout'))
+        if key not in self.deps:
+            files = self.resolve_files(tmpl)
+            self.deps[key] = (files, ''.join(repr((f, self.stamp(f)))
+                                             for f in files))
+        return self.deps[key]
+
+    def resolve_files(self, tmpl):
+        deps = [tmpl.filename]
+        refs = list(self.references(tmpl.filename))
+        layout = tmpl.layouts.get(tmpl.context.get('layout'))
+        while layout is not None and layout.filename not in deps:
+            deps.append(layout.filename)
+            refs.extend(self.references(layout.filename))
+            layout = tmpl.layouts.get(layout.layout)
+        while refs:
+            fname = refs.pop()
+            if fname not in deps:
+                deps.append(fname)
+                refs.extend(self.references(fname))
+        return deps
+
+    def fingerprint(self, value, files = None):
+        """ hash a site collection. templates are represented by the
+            stamps of all files they depend on, which are added to files,
+            if given.
+        """
+        h = hashlib.sha1()
+
+        def feed(value):
+            if isinstance(value, Template):
+                deps, stamps = self.state(value)
+                h.update(stamps)
+                if files is not None:
+                    files.update(deps)
+            elif isinstance(value, dict):
+                for k in sorted(value, key = repr):
+                    h.update(repr(k))
+                    feed(value[k])
+            elif isinstance(value, (list, tuple)):
+                h.update('[%d' % len(value))
+                for v in value:
+                    feed(v)
+            else:
+                h.update(repr(value))
+        feed(value)
+        return h.hexdigest()
+
+    def collection(self, site, name):
+        if name not in self.fingerprints:
+            files = set()
+            self.fingerprints[name] = (self.fingerprint(site.get(name),
+                                                        files), files)
+        return self.fingerprints[name][0]
+
+    def outdated(self, tmpl):
+        """ return true, if the output of tmpl has to be generated.
+        """
+        entry = self.previous.get(tmpl.path)
+        if self.force or entry is None:
+            return True
+        if not os.path.exists(os.path.join(self.DEPLOY_DIR, tmpl.path)):
+            return True
+        return self.changed(tmpl, entry)
+
+    def changed(self, tmpl, entry):
+        """ return true, if any of the inputs recorded in entry (see
+            dependencies) changed.
+        """
+        files = self.files(tmpl)
+        if sorted(files) != sorted(entry['files']):
+            return True
+        for fname, stamp in entry['files'].iteritems():
+            if self.stamp(fname) != stamp:
+                return True
+        site = tmpl.context.get('site', {})
+        for name, fp in entry['site'].iteritems():
+            if self.collection(site, name) != fp:
+                return True
+        inputs = tmpl.inputs()
+        if sorted(inputs) != sorted(entry.get('inputs', {})):
+            return True
+        for name, fp in entry.get('inputs', {}).iteritems():
+            if self.fingerprint(inputs[name]) != fp:
+                return True
+        return False
+
+    def begin(self):
+        SiteDict.accessed = set()
+
+    def record(self, tmpl, accessed = None):
+        """ record the dependencies of a just generated template.
+        """
+        self.outputs[tmpl.path] = self.dependencies(tmpl, accessed)
+
+    def dependencies(self, tmpl, accessed = None):
+        """ return the current state of all inputs of a just generated
+            template. if accessed is not given, the site items looked up
+            since begin() are used.
+        """
+        if accessed is None:
+            accessed = SiteDict.accessed or set()
+        SiteDict.accessed = None
+        site = tmpl.context.get('site', {})
+        return dict(
+            files = dict((f, self.stamp(f)) for f in self.files(tmpl)),
+            site = dict((name, self.collection(site, name))
+                        for name in accessed
+                        if name not in self.VOLATILE),
+            inputs = dict((name, self.fingerprint(value))
+                          for name, value in tmpl.inputs().iteritems()))
+
+
+class Watcher(Config):
+    """ watch the site directory for changes by polling the modification
+        time and size of all files.
+    """
+
+    INTERVAL = 1.0
+
+    def __init__(self, path):
+        super(Watcher, self).__init__()
+        self.path = path
+        self.snapshot = self.scan()
+
+    def ignored(self, path):
+        """ ignore hidden files and the deploy and cache directories.
+        """
+        return (os.path.basename(path).startswith('.') or
+                os.path.abspath(path) in (os.path.abspath(self.DEPLOY_DIR),
+                                          os.path.abspath(self.CACHE_DIR)))
+
+    def scan(self):
+        snapshot = {}
+        for root, dirs, files in os.walk(self.path):
+            dirs[:] = [d for d in dirs
+                       if not self.ignored(os.path.join(root, d))]
+            for f in files:
+                fname = os.path.join(root, f)
+                if not self.ignored(fname):
+                    try:
+                        st = os.stat(fname)
+                        snapshot[fname] = (st.st_mtime, st.st_size)
+                    except OSError:
+                        pass
+        return snapshot
+
+    def wait(self):
+        """ block until something changed and return the set of added,
+            modified and removed paths.
+        """
+        while True:
+            time.sleep(self.INTERVAL)
+            snapshot = self.scan()
+            changed = set(f for f in set(snapshot) | set(self.snapshot)
+                          if snapshot.get(f) != self.snapshot.get(f))
+            self.snapshot = snapshot
+            if changed:
+                return changed
+
+
+class InotifyWatcher(Watcher):
+    """ watch the site directory for changes using linux inotify. bursts
+        of events (e.g. an editor saving a file) are collected until no
+        new event arrived for DEBOUNCE seconds.
+    """
+
+    DEBOUNCE = 0.1
+
+    IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x002, 0x004, 0x008
+    IN_MOVED_FROM, IN_MOVED_TO = 0x040, 0x080
+    IN_CREATE, IN_DELETE, IN_DELETE_SELF = 0x100, 0x200, 0x400
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+            IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, path):
+        import ctypes
+
+        self.path = path
+        self.libc = libc()
+        if not hasattr(self.libc, 'inotify_init'):
+            raise OSError('inotify not available')
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.watches = {}
+        self.overflow = False
+        self.watch(path)
+
+    def watch(self, path):
+        """ add watches for path and all its subdirectories.
+        """
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs
+                       if not self.ignored(os.path.join(root, d))]
+            wd = self.libc.inotify_add_watch(self.fd, root, self.MASK)
+            if wd >= 0:
+                self.watches[wd] = root
+
+    def read(self, timeout = None):
+        """ read pending events and return the affected paths. if the
+            event queue overflowed, events are lost and overflow is set.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return None
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, pos)
+            pos += self.EVENT.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+
+            if wd == -1 or mask & self.IN_Q_OVERFLOW:
+                # lost events may include new directories, watch them too.
+                self.overflow = True
+                self.watch(self.path)
+                continue
+            root = self.watches.get(wd)
+            if root is None:
+                continue
+            if mask & self.IN_IGNORED:
+                del self.watches[wd]
+                continue
+            path = os.path.join(root, name) if name else root
+            if self.ignored(path):
+                continue
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE |
+                                                self.IN_MOVED_TO):
+                self.watch(path)
+                for r, dirs, files in os.walk(path):
+                    changed.update(os.path.join(r, f) for f in files)
+            changed.add(path)
+        return changed
+
+    def wait(self):
+        """ like Watcher.wait, but return None if events were lost, in
+            which case the whole site has to be scanned again.
+        """
+        changed = set()
+        while not changed and not self.overflow:
+            changed = self.read()
+        while True:
+            more = self.read(self.DEBOUNCE)
+            if more is None:
+                break
+            changed |= more
+        if self.overflow:
+            self.overflow = False
+            return None
+        return changed
+
+
+def writePending(index):
+    """ write a queued template in a worker process and return whether
+        it was written, the site items it looked up, the files to record
+        in the deploy manifest and the profiler results. the workers are
+        forked, so they share the hooks, transformers and template filters
+        of the parent.
+    """
+    profiler.clear()
+    compressor.pending = []
+    manifest = Config.deploy_manifest
+    if manifest is not None:
+        manifest.recorded = []
+    SiteDict.accessed = set()
+    written = Site.PENDING[index].write()
+    accessed, SiteDict.accessed = SiteDict.accessed, None
+    compressor.flush()
+    recorded = manifest.recorded if manifest is not None else []
+    return written, accessed, recorded, profiler.take()
+
+
 class Site(Config):
     """ controls the site and holds the global context object. the context
         object contains all layouts, all posts and categories.
@@ -288,6 +1966,7 @@ class Site(Config):
 
     CONTEXT = AttrDict()
     IGNORE = ('_', '.')
+    PENDING = []
 
     def __init__(self):
         super(Site, self).__init__()
@@ -296,34 +1975,106 @@ class Site(Config):
             sys.path.append(self.LIB_DIR)
 
         self.layouts = {}
-
-        self.hooks()
+        self.jobs = 1
+        self.hardlink = False
+        # the paths changed since the last build, if known. hooks may
+        # keep the state of other files during prepare and run.
+        self.changed = None
+        self.stats = collections.Counter()
+        self.profile = False
+        self.cgi = False
+        self.live = False
+        self.server = None
+        self.lock = threading.RLock()
+
+        with profiler.span('hooks'):
+            self.hooks()
 
         self.context = Site.CONTEXT.copy()
-        if not 'site' in self.context:
-            self.context.site = AttrDict()
+        self.context.site = SiteDict(self.context.get('site', {}))
 
         self.context.site.now = datetime.datetime.now()
 
+        self.graph = BuildGraph(os.path.join(self.CACHE_DIR,
+                                             'manifest.json'))
+        fragments.graph = self.graph
+        fragments.path = os.path.join(self.CACHE_DIR, 'fragments')
+
     def hooks(self):
         """ load all available hooks from the _hooks/ directory.
         """
         if os.path.isdir(self.HOOK_DIR):
             for f in sorted(self.ignoreFilter(os.listdir(self.HOOK_DIR))):
                 if f.endswith('.py'):
-                    execfile(os.path.join(self.HOOK_DIR, f), globals())
+                    code = self.compileHook(os.path.join(self.HOOK_DIR, f))
+                    exec code in globals()
+
+    def compileHook(self, fname):
+        """ return the code object of the hook fname. compiled hooks are
+            kept in the cache directory, as long as the source and the
+            python version don't change.
+        """
+        st = os.stat(fname)
+        stamp = imp.get_magic() + marshal.dumps((fname, st.st_mtime,
+                                                     st.st_size))
+        cname = os.path.join(self.CACHE_DIR, 'hooks',
+                             os.path.basename(fname) + 'c')
+        try:
+            f = file(cname, 'rb')
+            try:
+                if f.read(len(stamp)) == stamp:
+                    return marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+
+        f = file(fname, 'rU')
+        try:
+            code = compile(f.read(), fname, 'exec')
+        finally:
+            f.close()
+        try:
+            if not os.path.isdir(os.path.dirname(cname)):
+                os.makedirs(os.path.dirname(cname))
+            writeFile(cname, stamp + marshal.dumps(code))
+        except (IOError, OSError):
+            pass
+        return code
 
     def prepare(self):
         """ read all layouts
         """
-        self.read_layouts()
+        self.graph.reset(self.changed)
+        self.stats.clear()
+        self.live_templates = {}
+        self.live_static = {}
+        fragments.clear()
+        with profiler.span('read_layouts'):
+            self.read_layouts()
 
     def run(self):
         """ generate the site content to the deploy directory.
         """
-        self.write_site_content()
-
-        if options.serve != None:
+        with profiler.span('write_site_content'):
+            self.write_site_content()
+        if not self.live:
+            with profiler.span('write_pending'):
+                self.write_pending()
+            with profiler.span('compress'):
+                self.stats['compressed'] = compressor.flush(self.jobs)
+            self.graph.save()
+            self.deploy_manifest.save()
+            self.report()
+
+        if self.profile:
+            profiler.save(os.path.join(self.CACHE_DIR, 'profile'))
+        profiler.clear()
+        self.changed = None
+
+        if self.server is not None:
+            self.server.update(self)
+        elif options.serve != None:
             try:
                 options.serve = (options.serve).strip('-')
                 port = int(options.serve)
@@ -338,6 +2089,8 @@ class Site(Config):
                                 for f in self.ignoreFilter(os.listdir(
                                                             self.LAYOUT_DIR))]
             self.layouts = dict((l.name, l) for l in self.layouts)
+            for l in self.layouts.itervalues():
+                l.pipeline(self.layouts)
 
     def write_site_content(self):
         """ copy site content to deploy directory.
@@ -356,39 +2109,172 @@ class Site(Config):
 
             for d in self.ignoreFilter(dirs):
                 nd = os.path.join(self.DEPLOY_DIR, base, d)
-                if not os.path.isdir(nd):
+                if not self.live and not os.path.isdir(nd):
                     os.makedirs(nd)
             dirs[:] = self.ignoreFilter(dirs)
 
             for f in self.ignoreFilter(files):
                 if Page.transformable(f):
-                    Page(os.path.join(root, f),
-                         self.layouts,
-                         self.context).write()
+                    self.write_template(Page(os.path.join(root, f),
+                                             self.layouts,
+                                             self.context))
                 else:
                     path = os.path.abspath(root)
                     path = path.replace(os.path.abspath(self.BASE_DIR), '', 1)
                     path = path.lstrip(os.path.sep)
                     path = os.path.join(self.DEPLOY_DIR, path)
-                    if not os.path.isdir(path):
-                        os.makedirs(path)
-                    shutil.copy(os.path.join(root, f), os.path.join(path, f))
+                    self.copy_static(os.path.join(root, f),
+                                     os.path.join(path, f))
+
+    def copy_static(self, src, dst):
+        """ copy a static file to the deploy directory, unless it's
+            already up to date.
+        """
+        if self.live:
+            path = os.path.relpath(dst, self.DEPLOY_DIR)
+            self.live_static[path.replace(os.path.sep, '/')] = src
+            return
+        with profiler.span('static', src):
+            copied = syncFile(src, dst, self.hardlink)
+        self.stats['copied' if copied else 'kept'] += 1
+        compressor.add(dst, copied)
+
+    def write_template(self, tmpl):
+        """ write a page or post, if any of its inputs changed since
+            the last run. in live mode, the template is only remembered
+            to be rendered on request.
+        """
+        if self.live:
+            self.live_templates[tmpl.path.replace(os.path.sep, '/')] = tmpl
+            return False
+        with profiler.span('outdated', tmpl.filename):
+            outdated = self.graph.outdated(tmpl)
+        if not outdated:
+            self.stats['current'] += 1
+            compressor.add(os.path.join(self.DEPLOY_DIR, tmpl.path),
+                           False, text = True)
+            return False
+        if self.jobs > 1 and hasattr(os, 'fork'):
+            Site.PENDING.append(tmpl)
+            return True
+        self.graph.begin()
+        self.count(tmpl.write())
+        self.graph.record(tmpl)
+        return True
+
+    def count(self, written):
+        """ count a generated page or post. templates are only written,
+            if their output changed.
+        """
+        self.stats['unchanged' if written is False else 'written'] += 1
+
+    def write_pending(self):
+        """ write all queued pages and posts using a pool of `jobs`
+            worker processes.
+        """
+        if not Site.PENDING:
+            return
+        import multiprocessing
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            chunksize = max(1, len(Site.PENDING) / (self.jobs * 4))
+            results = pool.map(writePending, range(len(Site.PENDING)),
+                               chunksize)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            pending, Site.PENDING = Site.PENDING, []
+
+        for tmpl, (written, accessed, recorded, profile) in zip(pending,
+                                                                results):
+            self.count(written)
+            self.graph.record(tmpl, accessed)
+            for fname, digest in recorded:
+                self.deploy_manifest.record(fname, digest)
+            profiler.merge(*profile)
+
+    def report(self):
+        """ print some statistics about the last run.
+        """
+        sys.stderr.write('%d written, %d unchanged, %d up to date, '
+                         '%d static files copied, %d kept\n' %
+                         (self.stats['written'], self.stats['unchanged'],
+                          self.stats['current'], self.stats['copied'],
+                          self.stats['kept']))
 
     def serve(self, port):
-        """ serve the deploy directory with a very simple, cgi
-            capable web server on 0.0.0.0:<port>.
+        """ serve the deploy directory on 0.0.0.0:<port>, using a
+            threaded, caching web server. if `cgi` is set, the very simple,
+            cgi capable web server is used instead.
+
+            in autoreload mode the server runs in the background, and its
+            cache is cleared after every build. in live mode, nothing is
+            written to the deploy directory, pages and posts are rendered
+            on request instead.
         """
-        from BaseHTTPServer import HTTPServer
-        from CGIHTTPServer import CGIHTTPRequestHandler
-        os.chdir(self.DEPLOY_DIR)
-        httpd = HTTPServer(('', int(port)), CGIHTTPRequestHandler)
+        if self.cgi:
+            from BaseHTTPServer import HTTPServer
+            from CGIHTTPServer import CGIHTTPRequestHandler
+            os.chdir(self.DEPLOY_DIR)
+            httpd = HTTPServer(('', int(port)), CGIHTTPRequestHandler)
+        elif self.live:
+            from growlserver import LiveHTTPServer, CachingRequestHandler
+            httpd = LiveHTTPServer(('', int(port)), CachingRequestHandler,
+                                   self)
+            httpd.update(self)
+        else:
+            from growlserver import ThreadingHTTPServer, \
+                                    CachingRequestHandler
+            httpd = ThreadingHTTPServer(('', int(port)),
+                                        CachingRequestHandler,
+                                        os.path.abspath(self.DEPLOY_DIR))
         sa = httpd.socket.getsockname()
         print "Serving HTTP on", sa[0], "port", sa[1], "..."
+
+        if self.options.autoreload and not self.cgi:
+            self.server = httpd
+            thread = threading.Thread(target = httpd.serve_forever)
+            thread.daemon = True
+            thread.start()
+            return
+
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
             pass
 
+    def daemon(self):
+        """ build the site once and then wait for build requests of
+            growl clients on _cache/daemon.sock (see growlc.py).
+        """
+        import socket
+        from growlserver import BuildDaemon
+
+        path = os.path.join(self.CACHE_DIR, 'daemon.sock')
+        if os.path.exists(path):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+                print 'error: a daemon is already running on %s' % path
+                sys.exit(1)
+            except socket.error:
+                os.unlink(path)
+            finally:
+                sock.close()
+        elif not os.path.isdir(self.CACHE_DIR):
+            os.makedirs(self.CACHE_DIR)
+
+        daemon = BuildDaemon(path, self)
+        daemon.build({})
+        print 'Waiting for build requests on', path, '...'
+        try:
+            daemon.serve()
+        except KeyboardInterrupt:
+            pass
+
     def ignoreFilter(self, seq):
         """ filter out files starting with self.IGNORE tokens
         """
@@ -400,38 +2286,14 @@ class Site(Config):
             return True
         return itertools.ifilter(ignore_filter, seq)
 
-    def files_changed(self, path, extensions):
-        """ return true if the files have changed since the last check
-        """
-        def file_times(path):
-            """ return the last time files have been modified
-            """
-            for root, dirs, files in os.walk(path):
-                dirs[:] = [x for x in dirs if x[0] != '.' and x != '_deploy']
-                for file in files:
-                    if any(file.endswith(ext) for ext in extensions):
-                        try:
-                            yield os.stat(os.path.join(root, file)).st_mtime
-                        except:
-                            yield None
-
-        global LAST_MTIME
-        mtime = max(file_times(path))
-        if mtime > LAST_MTIME:
-            LAST_MTIME = mtime
-            return True
-        return False
-
-    def get_extensions(self, path):
-        """ get all filename extensions and ignore the `_deploy` directory
+    def watcher(self):
+        """ return a watcher for the site directory. uses inotify if
+            available, polling otherwise.
         """
-        exts = []
-        for root, dirs, files in os.walk(path):
-            dirs[:] = [x for x in dirs if x[0] != '.' and x != '_deploy']
-            for file in files:
-                ext = os.path.splitext(file)[-1][1:]
-                exts.append(ext)
-        return set(exts)
+        try:
+            return InotifyWatcher(self.BASE_DIR)
+        except (OSError, AttributeError):
+            return Watcher(self.BASE_DIR)
 
     def setupOptions(self, parser):
         parser.add_option('--serve',
@@ -439,6 +2301,58 @@ class Site(Config):
                           metavar = 'PORT',
                           help = 'Start web server')
 
+        parser.set_defaults(rebuild = False)
+        parser.add_option('-f', '--rebuild',
+                          action = 'store_true', dest = 'rebuild',
+                          help = 'Regenerate all pages and posts, even if'
+                                 ' their inputs did not change.')
+
+        parser.set_defaults(jobs = 1)
+        parser.add_option('-j', '--jobs',
+                          action = 'store', dest = 'jobs', type = 'int',
+                          metavar = 'N',
+                          help = 'Render pages and posts using N worker'
+                                 ' processes.')
+
+        parser.set_defaults(hardlink = False)
+        parser.add_option('--hardlink',
+                          action = 'store_true', dest = 'hardlink',
+                          help = 'Hardlink static files into the deploy'
+                                 ' directory instead of copying them.')
+
+        parser.set_defaults(compress = False)
+        parser.add_option('-z', '--compress',
+                          action = 'store_true', dest = 'compress',
+                          help = 'Write gzip (and brotli) compressed'
+                                 ' copies of all changed text files.')
+
+        parser.set_defaults(profile = False)
+        parser.add_option('--profile',
+                          action = 'store_true', dest = 'profile',
+                          help = 'Record timings of all build phases and'
+                                 ' files to _cache/profile.json and'
+                                 ' _cache/profile.trace.json.')
+
+        parser.set_defaults(live = False)
+        parser.add_option('--live',
+                          action = 'store_true', dest = 'live',
+                          help = 'Together with --serve, render pages and'
+                                 ' posts on request instead of writing them'
+                                 ' to the deploy directory. Implies'
+                                 ' --autoreload.')
+
+        parser.set_defaults(daemon = False)
+        parser.add_option('--daemon',
+                          action = 'store_true', dest = 'daemon',
+                          help = 'Keep the site in memory and build it on'
+                                 ' request of growlc.py.')
+
+        parser.set_defaults(cgi = False)
+        parser.add_option('--cgi',
+                          action = 'store_true', dest = 'cgi',
+                          help = 'Serve using the simple, cgi capable'
+                                 ' web server.')
+
         parser.set_defaults(version = False)
         parser.add_option('-v', '--version',
                           action = 'store_true', dest = 'version',
@@ -451,23 +2365,42 @@ class Site(Config):
 
 if __name__ == '__main__':
     DEFAULT_PORT = 8080
-    LAST_MTIME = 0
     parser = OptionParser(usage = 'syntax: %prog [options] <from> [to]')
 
     base = deploy_path = None
     args = sys.argv[1:]
 
-    for arg in sys.argv[:0:-1]:
-        if not arg.startswith('-'):
-            if not deploy_path:
-                deploy_path = arg
-            elif not base:
-                base = arg
-        elif arg == '--':
-            break
-
-    if not base and deploy_path:
-        base = deploy_path
+    # the site directory has to be known before the hooks are loaded, which
+    # may add options on their own. so the arguments are scanned using the
+    # core options only, options unknown so far are assumed to be flags.
+    scanner = OptionParser()
+    Site.setupOptions.im_func(None, scanner)
+
+    def takesValue(opt):
+        return scanner.has_option(opt) and \
+                    scanner.get_option(opt).takes_value()
+
+    positional = []
+    rest = iter(args)
+    for arg in rest:
+        if arg == '--':
+            positional.extend(rest)
+        elif arg.startswith('--'):
+            if '=' not in arg and takesValue(arg):
+                next(rest, None)
+        elif arg.startswith('-') and arg != '-':
+            for i, c in enumerate(arg[1:]):
+                if takesValue('-' + c):
+                    if i == len(arg) - 2:
+                        next(rest, None)
+                    break
+        else:
+            positional.append(arg)
+
+    if len(positional) > 1:
+        base, deploy_path = positional[-2:]
+    elif positional:
+        base = positional[0]
         deploy_path = os.path.join(base, '_deploy')
 
     if base and os.path.isdir(base):
@@ -491,35 +2424,51 @@ if __name__ == '__main__':
         print 'error: invalid directory: %s' % base
         sys.exit(2)
 
-    try:
-        import markdown
-        Config.transformers.setdefault('markdown', markdown.markdown)
-    except ImportError:
-        pass
-
-    try:
-        import textile
-        Config.transformers.setdefault('textile', textile.textile)
-    except ImportError:
-        pass
+    for module in ('markdown', 'textile'):
+        if LazyTransformer.available(module):
+            Config.transformers.setdefault(module,
+                                           LazyTransformer(module, module))
 
     try:
         # set jinja2 loader to enable template inheritance
         jinja2_env.loader = jinja2.FileSystemLoader(site.LAYOUT_DIR)
+
+        # keep compiled templates between runs
+        bcc_dir = os.path.join(site.CACHE_DIR, 'jinja2')
+        if not os.path.isdir(bcc_dir):
+            os.makedirs(bcc_dir)
+        jinja2_env.bytecode_cache = AtomicBytecodeCache(bcc_dir)
     except NameError:
         pass
 
     site.options = options
-
-    extensions = site.get_extensions(base)
-
-    if options.autoreload:
+    site.graph.force = options.rebuild
+    site.jobs = options.jobs
+    site.hardlink = options.hardlink
+    site.profile = profiler.enabled = options.profile
+    site.cgi = options.cgi
+    compressor.enabled = options.compress
+    site.live = options.live and options.serve is not None
+    if site.live:
+        options.autoreload = True
+
+    if options.daemon:
+        if options.serve is not None or options.autoreload:
+            parser.error('--daemon can\'t be combined with --serve or'
+                         ' --autoreload')
+        site.daemon()
+    elif options.autoreload:
+        watcher = site.watcher()
+        with site.lock:
+            site.prepare()
+            site.run()
         while True:
             try:
-                if site.files_changed(base, extensions):
+                changed = watcher.wait()
+                with site.lock:
+                    site.changed = changed
                     site.prepare()
                     site.run()
-                time.sleep(1)
             except KeyboardInterrupt:
                 break
     else:
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+# vim:syntax=python:sw=4:ts=4:expandtab
+#
+# Copyright (C) 2012 Rico Schiekel (fire at downgra dot de)
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License version 2
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+#
+
+""" thin client for a growl daemon (growl.py --daemon <site>).
+
+    > growlc.py my.site                           # build
+    > growlc.py my.site build _posts/new-post.md  # only this file changed
+    > growlc.py my.site status
+    > growlc.py my.site stop
+
+    only the standard library is imported, so a request costs little more
+    than the build itself.
+"""
+
+import os
+import sys
+import json
+import socket
+from optparse import OptionParser
+
+
+COMMANDS = ('build', 'status', 'stop')
+
+
+def request(path, req):
+    """ send req to the daemon listening on path and return its response.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        f = sock.makefile('r+b')
+        f.write(json.dumps(req) + '\n')
+        f.flush()
+        line = f.readline()
+        f.close()
+    finally:
+        sock.close()
+    if not line:
+        raise socket.error('connection closed by daemon')
+    return json.loads(line)
+
+
+def main():
+    parser = OptionParser(usage = 'syntax: %prog [options] <site>'
+                                  ' [build [paths...] | status | stop]')
+    parser.set_defaults(rebuild = False)
+    parser.add_option('-f', '--rebuild',
+                      action = 'store_true', dest = 'rebuild',
+                      help = 'Regenerate all pages and posts, even if'
+                             ' their inputs did not change.')
+    (options, args) = parser.parse_args()
+
+    if not args:
+        parser.error('"site" parameter missing!')
+    base = args[0]
+    command = args[1] if len(args) > 1 else 'build'
+    if command not in COMMANDS:
+        parser.error('unknown command: %s' % command)
+
+    req = dict(command = command)
+    if command == 'build':
+        req['rebuild'] = options.rebuild
+        req['paths'] = [os.path.relpath(os.path.abspath(p),
+                                        os.path.abspath(base))
+                        for p in args[2:]]
+
+    path = os.path.join(base, '_cache', 'daemon.sock')
+    try:
+        response = request(path, req)
+    except socket.error, e:
+        print 'error: no growl daemon running on %s (%s)' % (path, e)
+        sys.exit(2)
+
+    if not response.get('ok'):
+        sys.stderr.write(response.get('error', 'failed') + '\n')
+        sys.exit(1)
+
+    if command == 'build':
+        stats = response['stats']
+        sys.stderr.write('%d written, %d unchanged, %d up to date, '
+                         '%d static files copied, %d kept (%.3fs)\n' %
+                         (stats.get('written', 0), stats.get('unchanged', 0),
+                          stats.get('current', 0), stats.get('copied', 0),
+                          stats.get('kept', 0), response['time']))
+    elif command == 'status':
+        print 'pid %d, site %s, up %ds, %d builds' % (
+                    response['pid'], response['base'], response['uptime'],
+                    response['builds'])
+        last = response.get('last')
+        if last:
+            print 'last build took %.3fs' % last['time']
+
+
+if __name__ == '__main__':
+    main()
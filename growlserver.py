@@ -0,0 +1,423 @@
+# vim:syntax=python:sw=4:ts=4:expandtab
+#
+# Copyright (C) 2012 Rico Schiekel (fire at downgra dot de)
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License version 2
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+#
+
+""" web server and build daemon of growl, only imported for --serve and
+    --daemon, so a plain build doesn't pay for loading the server modules.
+"""
+
+import os
+import time
+import datetime
+import collections
+import itertools
+import threading
+import shutil
+import hashlib
+import errno
+import json
+import gzip
+import mimetypes
+import posixpath
+import urllib
+import email.utils
+import BaseHTTPServer
+import SocketServer
+from cStringIO import StringIO
+
+
+class FileCache(object):
+    """ thread safe lru cache for the content of the served files. entries
+        are validated by modification time and size of the file. text files
+        are also kept gzip compressed (or the precompressed `.gz` sibling
+        is used, if it exists).
+    """
+
+    MAX_SIZE = 64 * 1024 * 1024
+    MAX_ENTRY = 4 * 1024 * 1024
+    COMPRESS_MIN = 256
+    COMPRESSIBLE = ('text/', 'application/javascript', 'application/json',
+                    'application/xml', 'application/atom+xml',
+                    'application/rss+xml', 'image/svg+xml')
+
+    Entry = collections.namedtuple('Entry', 'stamp etag ctype data gzdata')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def get(self, fname):
+        """ return the cache entry for fname. data is None for files
+            larger than MAX_ENTRY, which have to be streamed.
+        """
+        st = os.stat(fname)
+        stamp = (st.st_mtime, st.st_size)
+        with self.lock:
+            entry = self.entries.pop(fname, None)
+            if entry is not None and entry.stamp == stamp:
+                self.entries[fname] = entry
+                return entry
+            if entry is not None:
+                self.size -= self.entry_size(entry)
+
+        entry = self.load(fname, stamp)
+        if entry.data is not None:
+            with self.lock:
+                self.entries[fname] = entry
+                self.size += self.entry_size(entry)
+                while self.size > self.MAX_SIZE:
+                    self.size -= self.entry_size(
+                                    self.entries.popitem(last = False)[1])
+        return entry
+
+    def entry_size(self, entry):
+        return len(entry.data or '') + len(entry.gzdata or '')
+
+    def load(self, fname, stamp):
+        ctype = mimetypes.guess_type(fname)[0] or 'application/octet-stream'
+        etag = '"%x-%x"' % (int(stamp[0] * 1000000), stamp[1])
+        if stamp[1] > self.MAX_ENTRY:
+            return self.Entry(stamp, etag, ctype, None, None)
+
+        f = file(fname, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        gzdata = None
+        if self.compressible(data, ctype):
+            try:
+                gz = os.stat(fname + '.gz')
+                if gz.st_mtime >= stamp[0]:
+                    gzdata = file(fname + '.gz', 'rb').read()
+            except (IOError, OSError):
+                pass
+        return self.Entry(stamp, etag, ctype, data,
+                          self.compress(data, ctype, gzdata))
+
+    def compressible(self, data, ctype):
+        return (len(data) >= self.COMPRESS_MIN and
+                ctype.startswith(self.COMPRESSIBLE))
+
+    def compress(self, data, ctype, gzdata = None):
+        """ return the gzip compressed data, or None if compression
+            isn't worth it.
+        """
+        if not self.compressible(data, ctype):
+            return None
+        if gzdata is None:
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj = buf, mode = 'wb', compresslevel = 6)
+            f.write(data)
+            f.close()
+            gzdata = buf.getvalue()
+        if len(gzdata) >= len(data):
+            return None
+        return gzdata
+
+
+class CachingRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ serve files of the deploy directory from the servers FileCache,
+        supporting keep-alive, conditional requests and gzip.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def translate_path(self, path):
+        """ return the normalized path relative to the site root.
+        """
+        path = urllib.unquote(path.split('?', 1)[0].split('#', 1)[0])
+        path = posixpath.normpath(path).lstrip('/')
+        return '/'.join(p for p in path.split('/')
+                        if p not in ('', '.', '..'))
+
+    def respond(self, body):
+        url = self.path.split('?', 1)[0]
+        try:
+            found = self.server.lookup(self.translate_path(url),
+                                       url.endswith('/'))
+        except (IOError, OSError):
+            self.send_error(404, 'File not found')
+            return
+        except Exception:
+            import traceback
+            self.send_text(500, traceback.format_exc())
+            return
+
+        if found is None:
+            # a directory, requested without a trailing slash
+            self.send_response(301)
+            self.send_header('Location', url + '/')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        entry, fname = found
+
+        data, etag = entry.data, entry.etag
+        gzipped = (entry.gzdata is not None and
+                   'gzip' in self.headers.get('Accept-Encoding', ''))
+        if gzipped:
+            data, etag = entry.gzdata, etag[:-1] + '-gzip"'
+
+        if self.not_modified(entry, etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', entry.ctype)
+        self.send_header('Content-Length', str(len(data) if data is not None
+                                               else entry.stamp[1]))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified',
+                         self.date_time_string(entry.stamp[0]))
+        if entry.gzdata is not None:
+            self.send_header('Vary', 'Accept-Encoding')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+
+        if not body:
+            return
+        if data is not None:
+            self.wfile.write(data)
+        else:
+            f = file(fname, 'rb')
+            try:
+                shutil.copyfileobj(f, self.wfile)
+            finally:
+                f.close()
+
+    def send_text(self, code, text):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def not_modified(self, entry, etag):
+        etags = self.headers.get('If-None-Match')
+        if etags is not None:
+            return etag in [e.strip() for e in etags.split(',')]
+        since = self.headers.get('If-Modified-Since')
+        if since is not None:
+            since = email.utils.parsedate_tz(since)
+            if since is not None:
+                return int(entry.stamp[0]) <= email.utils.mktime_tz(since)
+        return False
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    """ http server handling each request in its own thread.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler, root):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        self.root = root
+        self.cache = FileCache()
+
+    def lookup(self, path, slash):
+        """ return the cache entry and filename for path, or None if path
+            is a directory and was requested without trailing slash.
+        """
+        fname = os.path.join(self.root, *path.split('/'))
+        if os.path.isdir(fname):
+            if not slash:
+                return None
+            fname = os.path.join(fname, 'index.html')
+        return self.cache.get(fname), fname
+
+    def update(self, site):
+        """ called after every build.
+        """
+        with self.cache.lock:
+            self.cache.clear()
+
+
+class LiveHTTPServer(ThreadingHTTPServer):
+    """ serve the site without writing the deploy directory. pages and
+        posts are rendered on request, and the result is kept until any
+        of its inputs changes. static files are served from the site
+        directory.
+    """
+
+    def __init__(self, address, handler, site):
+        ThreadingHTTPServer.__init__(self, address, handler, None)
+        self.site = site
+        self.templates = {}
+        self.static = {}
+        self.dirs = set()
+        self.rendered = {}
+
+    def update(self, site):
+        """ take over the pages, posts and static files collected by
+            the last run of site.
+        """
+        dirs = set()
+        for path in itertools.chain(site.live_templates, site.live_static):
+            while path:
+                path = posixpath.dirname(path)
+                dirs.add(path)
+        self.templates = site.live_templates
+        self.static = site.live_static
+        self.dirs = dirs
+
+    def lookup(self, path, slash):
+        if path in self.dirs:
+            if path and not slash:
+                return None
+            path = posixpath.join(path, 'index.html')
+
+        with self.site.lock:
+            tmpl = self.templates.get(path)
+            if tmpl is not None:
+                return self.render(path, tmpl), None
+            src = self.static.get(path)
+        if src is None:
+            raise IOError(errno.ENOENT, 'not found', path)
+        return self.cache.get(src), src
+
+    def render(self, path, tmpl):
+        graph = self.site.graph
+        cached = self.rendered.get(path)
+        if cached is not None and not graph.changed(tmpl, cached[0]):
+            return cached[1]
+
+        graph.begin()
+        data = tmpl.layout().encode('utf8')
+        deps = graph.dependencies(tmpl)
+        ctype = mimetypes.guess_type(path)[0] or 'text/html'
+        entry = FileCache.Entry((time.time(), len(data)),
+                                '"%s"' % hashlib.sha1(data).hexdigest(),
+                                ctype, data, self.cache.compress(data, ctype))
+        self.rendered[path] = (deps, entry)
+        return entry
+
+
+class BuildRequestHandler(SocketServer.StreamRequestHandler):
+    """ handle the requests of a growl client. every request and every
+        response is a single line of json.
+    """
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                request = json.loads(line)
+                command = self.server.COMMANDS[request.get('command',
+                                                           'build')]
+                response = getattr(self.server, command)(request)
+            except KeyError:
+                response = dict(ok = False, error = 'unknown command')
+            except Exception:
+                import traceback
+                response = dict(ok = False, error = traceback.format_exc())
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+# unix sockets are not available on all platforms, there --daemon fails.
+class BuildDaemon(getattr(SocketServer, 'UnixStreamServer',
+                          SocketServer.TCPServer)):
+    """ keep a site (with its hooks, layouts, parsed headers and caches)
+        in memory and build it on request of growl clients connecting to
+        the unix socket at path.
+
+        a build request may list the paths which changed since the last
+        build, then only their state is read again.
+    """
+
+    COMMANDS = dict(build = 'build', status = 'status', stop = 'stop')
+
+    def __init__(self, path, site):
+        SocketServer.TCPServer.__init__(self, path, BuildRequestHandler)
+        self.site = site
+        self.started = time.time()
+        self.builds = 0
+        self.last = None
+        self.running = True
+
+    def server_bind(self):
+        """ create the socket with mode 0600, only the owner of the site
+            may request builds.
+        """
+        umask = os.umask(0177)
+        try:
+            SocketServer.TCPServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+    def build(self, request):
+        site = self.site
+        base = os.path.abspath(site.BASE_DIR)
+        changed = None
+        if request.get('paths'):
+            changed = set(os.path.join(site.BASE_DIR, os.path.relpath(
+                                os.path.join(base, p), base))
+                          for p in request['paths'])
+
+        start = time.time()
+        force = site.graph.force
+        with site.lock:
+            site.changed = changed
+            site.graph.force = force or bool(request.get('rebuild'))
+            site.context.site.now = datetime.datetime.now()
+            try:
+                site.prepare()
+                site.run()
+            finally:
+                site.graph.force = force
+        self.builds += 1
+        self.last = dict(stats = dict(site.stats),
+                         time = time.time() - start,
+                         finished = time.time())
+        return dict(self.last, ok = True)
+
+    def status(self, request):
+        return dict(ok = True, pid = os.getpid(),
+                    base = os.path.abspath(self.site.BASE_DIR),
+                    uptime = time.time() - self.started,
+                    builds = self.builds, last = self.last)
+
+    def stop(self, request):
+        self.running = False
+        return dict(ok = True)
+
+    def serve(self):
+        try:
+            while self.running:
+                self.handle_request()
+        finally:
+            self.server_close()
+            os.unlink(self.server_address)
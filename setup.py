@@ -3,5 +3,6 @@ from setuptools import setup
 setup(
     name="growl",
     version="0.3",
-    scripts=["growl.py"]
+    scripts=["growl.py", "growlc.py"],
+    py_modules=["growlserver"]
 )
\ No newline at end of file